@@ -1,17 +1,12 @@
-import json
+import os
 import yaml
+import hashlib
 import shutil
 from pathlib import Path
-from google import genai
-from google.genai.types import (
-    GenerateContentConfig,
-    HarmBlockThreshold,
-    HarmCategory,
-    Part,
-    SafetySetting
-)
 from utils.network_utils import generate_content_with_retry, get_default_generation_config
-from pdf_compressor import compress_pdf
+from utils.json_utils import json_loads, json_dumps
+from utils.config_parser import YamlLoader
+from pdf_compressor import compress_pdf, create_render_pool
 import argparse
 from loguru import logger
 from utils.logging_config import configure_logging
@@ -19,11 +14,62 @@ from utils.logging_config import configure_logging
 # Configure logger
 logger = configure_logging()
 
+# Prompt for the structure analysis; only the book title varies between calls
+STRUCTURE_PROMPT_TEMPLATE = """
+    Analyze this book PDF with title "{book_title}" and provide a detailed breakdown of its structure.
+    Include the following elements:
+    1. Cover page (page number)
+    2. Table of contents (page numbers)
+    3. All chapters and subchapters as referenced in the table of contents
+    4. Back cover page (page number)
+    
+    Important: Use the PDF page numbers (not the printed page numbers that might appear in the table of contents).
+    Note that nearby chapters may overlap if there are no page breaks.
+    Keep the original language for all titles.
+    
+    Return the result in the following JSON structure:
+    {{
+        "cover_page": {{
+            "page_number": int
+        }},
+        "table_of_contents": {{
+            "start_page": int,
+            "end_page": int,
+            "entries": [
+                {{
+                    "title": string,
+                    "page_number": int,
+                    "level": int  # 1 for main chapter, 2 for subchapter, etc.
+                }}
+            ]
+        }},
+        "chapters": [
+            {{
+                "title": string,
+                "start_page": int,
+                "end_page": int,
+                "level": int,
+                "subchapters": [
+                    {{
+                        "title": string,
+                        "start_page": int,
+                        "end_page": int,
+                        "level": int
+                    }}
+                ]
+            }}
+        ],
+        "back_cover": {{
+            "page_number": int
+        }}
+    }}
+    """
+
 
 def load_config(config_path="config.yaml"):
     """Load configuration from config file."""
     with open(config_path, "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=YamlLoader)
     return config
 
 
@@ -33,6 +79,17 @@ def setup_genai_api(api_key):
     return setup_genai_client(api_key)
 
 
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst when both are on the same filesystem, otherwise copy it.
+    Safe here because processed files are only ever replaced, never modified in place.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def preprocess_pdf(input_pdf, output_dir):
     """
     Check if PDF is too large and compress it if necessary.
@@ -49,33 +106,47 @@ def preprocess_pdf(input_pdf, output_dir):
     if processed_pdf.exists() and original_pdf.exists():
         return processed_pdf
 
-    # Copy the input file if needed (first time processing)
+    # Link or copy the input file if needed (first time processing)
     if not processed_pdf.exists():
-        shutil.copy2(input_pdf, processed_pdf)
+        link_or_copy(input_pdf, processed_pdf)
 
-    # Get file size in MB
+    # Get file size in MB once; nothing to do if it is within the limit
     file_size_mb = processed_pdf.stat().st_size / (1024 * 1024)
+    if file_size_mb <= 45:
+        return processed_pdf
 
-    # If file size > 45MB, compress it
-    if file_size_mb > 45:
-        logger.warning(f"PDF file size ({file_size_mb:.2f}MB) exceeds 45MB. Compressing...")
-
-        # Backup original PDF if not already done
-        if not original_pdf.exists():
-            shutil.copy2(processed_pdf, original_pdf)
-
-        # Create temporary file for compression output
-        temp_output = output_dir / "compressed_temp.pdf"
+    logger.warning(f"PDF file size ({file_size_mb:.2f}MB) exceeds 45MB. Compressing...")
+    original_size_mb = file_size_mb
+
+    # Backup original PDF if not already done
+    if not original_pdf.exists():
+        link_or_copy(processed_pdf, original_pdf)
+
+    # Create temporary file for compression output
+    temp_output = output_dir / "compressed_temp.pdf"
+
+    # Reuse an earlier compression of identical input, keyed by content hash
+    cache_dir = output_dir.parent / ".compress_cache"
+    with open(processed_pdf, "rb") as f:
+        digest = hashlib.file_digest(f, "blake2b").hexdigest()
+    cached_pdf = cache_dir / f"{digest}.pdf"
+    if cached_pdf.exists():
+        logger.info(f"Using cached compressed PDF {cached_pdf}")
+        link_or_copy(cached_pdf, temp_output)
+        os.replace(temp_output, processed_pdf)
+        return processed_pdf
 
-        # Start with moderate compression settings
-        compression_settings = [
-            # (dpi, quality, grayscale)
-            (150, 60, False),  # Medium compression
-            (120, 40, False),  # Higher compression
-            (100, 30, True)    # Aggressive compression with grayscale
-        ]
+    # Start with moderate compression settings
+    compression_settings = [
+        # (dpi, quality, grayscale)
+        (150, 60, False),  # Medium compression
+        (120, 40, False),  # Higher compression
+        (100, 30, True)    # Aggressive compression with grayscale
+    ]
 
-        # Try compression with increasingly aggressive settings until size is under limit
+    # Try compression with increasingly aggressive settings until size is under limit;
+    # every attempt renders pages in the same worker processes
+    with create_render_pool() as render_pool:
         for dpi, quality, grayscale in compression_settings:
             try:
                 logger.info(f"Trying compression with DPI={dpi}, quality={quality}, grayscale={grayscale}...")
@@ -84,7 +155,8 @@ def preprocess_pdf(input_pdf, output_dir):
                     str(temp_output), 
                     dpi=dpi, 
                     quality=quality, 
-                    grayscale=grayscale
+                    grayscale=grayscale,
+                    executor=render_pool,
                 )
 
                 if success:
@@ -97,7 +169,8 @@ def preprocess_pdf(input_pdf, output_dir):
                     if compressed_size_mb < file_size_mb:
                         # Replace the processed file with our compressed version
                         if temp_output.exists():
-                            shutil.move(str(temp_output), str(processed_pdf))
+                            os.replace(temp_output, processed_pdf)
+                            file_size_mb = compressed_size_mb
                     else:
                         logger.warning("Compression did not reduce file size. Keeping original.")
 
@@ -112,74 +185,29 @@ def preprocess_pdf(input_pdf, output_dir):
             if temp_output.exists():
                 temp_output.unlink()
 
-        # Check final file size
-        final_size_mb = processed_pdf.stat().st_size / (1024 * 1024)
-        if final_size_mb > 45:
-            logger.warning(f"PDF is still {final_size_mb:.2f}MB (larger than 45MB) after compression")
+    # Check final file size, tracked from the compression stats
+    if file_size_mb > 45:
+        logger.warning(f"PDF is still {file_size_mb:.2f}MB (larger than 45MB) after compression")
+
+    # Cache the compressed result for future runs on the same input
+    if file_size_mb < original_size_mb:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        link_or_copy(processed_pdf, cached_pdf)
 
     return processed_pdf
 
 
-def analyze_pdf_structure(client: genai.Client, pdf_path, book_title, config):
+def analyze_pdf_structure(client, pdf_path, book_title, config):
     """Use Gemini model to analyze the PDF structure from the full PDF."""
-    prompt = f"""
-    Analyze this book PDF with title "{book_title}" and provide a detailed breakdown of its structure.
-    Include the following elements:
-    1. Cover page (page number)
-    2. Table of contents (page numbers)
-    3. All chapters and subchapters as referenced in the table of contents
-    4. Back cover page (page number)
-    
-    Important: Use the PDF page numbers (not the printed page numbers that might appear in the table of contents).
-    Note that nearby chapters may overlap if there are no page breaks.
-    Keep the original language for all titles.
-    
-    Return the result in the following JSON structure:
-    {{
-        "cover_page": {{
-            "page_number": int
-        }},
-        "table_of_contents": {{
-            "start_page": int,
-            "end_page": int,
-            "entries": [
-                {{
-                    "title": string,
-                    "page_number": int,
-                    "level": int  # 1 for main chapter, 2 for subchapter, etc.
-                }}
-            ]
-        }},
-        "chapters": [
-            {{
-                "title": string,
-                "start_page": int,
-                "end_page": int,
-                "level": int,
-                "subchapters": [
-                    {{
-                        "title": string,
-                        "start_page": int,
-                        "end_page": int,
-                        "level": int
-                    }}
-                ]
-            }}
-        ],
-        "back_cover": {{
-            "page_number": int
-        }}
-    }}
-    """
-
-    # Read the PDF file as binary
-    with open(pdf_path, "rb") as f:
-        pdf_data = f.read()
+    prompt = STRUCTURE_PROMPT_TEMPLATE.format(book_title=book_title)
 
-    # Create parts for the multimodal input - text and PDF data
+    # Create parts for the multimodal input - text and PDF data.
+    # The PDF is read straight into the Part so only one copy stays in memory,
+    # and the same parts list is reused by every retry attempt.
+    from google.genai.types import Part
     parts = [
         prompt,
-        Part.from_bytes(data=pdf_data, mime_type="application/pdf"),
+        Part.from_bytes(data=Path(pdf_path).read_bytes(), mime_type="application/pdf"),
     ]
 
     # Get model from config with fallback
@@ -189,36 +217,12 @@ def analyze_pdf_structure(client: genai.Client, pdf_path, book_title, config):
     num_retries = config.get("num_retries", 3)
     max_backoff = config.get("max_backoff_seconds", 30)
     
-    # Create generation config
-    generation_config = GenerateContentConfig(
-        temperature=0.1,
-        response_mime_type="application/json",
-        safety_settings=[
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-        ],
-    )
-    
     # Generate content with retry (using streaming for better performance)
     response = generate_content_with_retry(
         client=client,
         model=model,
         contents=parts,
-        config=generation_config,
+        config=get_default_generation_config(temperature=0.1, response_mime_type="application/json"),
         max_retries=num_retries,
         max_backoff=max_backoff,
         operation_name="PDF structure analysis",
@@ -228,7 +232,7 @@ def analyze_pdf_structure(client: genai.Client, pdf_path, book_title, config):
     logger.debug(f"API response: {response}")
 
     # Parse the response as JSON
-    return json.loads(response.text)
+    return json_loads(response.text)
 
 
 def main():
@@ -273,8 +277,7 @@ def main():
 
         # Save the structured output to the output directory
         output_file = output_dir / "book_structure.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(structure, f, ensure_ascii=False, indent=2)
+        output_file.write_bytes(json_dumps(structure, indent=True))
 
         logger.success(f"Book structure analysis completed and saved to {output_file}")
 
@@ -1,28 +1,26 @@
 import json
 import os
+import mmap
 import uuid
-import shutil
 import fitz  # PyMuPDF
 import yaml
 import zipfile
 import re
 import argparse
 import time
-from io import BytesIO
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from PIL import Image
-from google import genai
+from xml.etree.ElementTree import ParseError, iterparse
+from xml.sax.saxutils import escape
 import httpx
 from utils.network_utils import generate_content_with_retry, get_default_generation_config
 from utils.html_utils import clean_html_response
-from google.genai.types import (
-    GenerateContentConfig,
-    HarmBlockThreshold,
-    HarmCategory,
-    Part,
-    SafetySetting,
-)
+from utils.json_utils import json_dumps
+from utils.config_parser import YamlLoader
+from utils.pdf_workers import extract_placeholder_images, to_jpeg_bytes
 from loguru import logger
 from utils.logging_config import configure_logging
 
@@ -30,11 +28,46 @@ from utils.logging_config import configure_logging
 # Configure logger
 logger = configure_logging()
 
+# Patterns for image references and placeholders, compiled once at import
+IMG_SRC_RE = re.compile(rb'<img src="\.\./images/([^"]+)"')
+IMAGE_PLACEHOLDER_RE = re.compile(
+    r'<div class="image-placeholder" id="([^"]+)" data-page="(\d+)" data-description="([^"]+)"></div>'
+)
+
+# PyMuPDF is not thread-safe, so chapters generated concurrently take turns reading the shared source document
+PDF_LOCK = threading.Lock()
+
+# Namespaced tags used to find cover references
+OPF_ITEM_TAG = "{http://www.idpf.org/2007/opf}item"
+SVG_IMAGE_TAG = "{http://www.w3.org/2000/svg}image"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# MuPDF holds the GIL while decoding images, so placeholder images are
+# extracted in worker processes instead of the chapter threads
+IMAGE_WORKERS = min(os.cpu_count() or 1, 4)
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+# Static EPUB files, pre-encoded so they can be written (or zipped) as-is
+MIMETYPE_BYTES = b"application/epub+zip"
+CONTAINER_XML_BYTES = b"""<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+   <rootfiles>
+      <rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
+   </rootfiles>
+</container>"""
+
+# Already-compressed formats are stored as-is rather than deflated again
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Manifest media types of the images that can be listed in content.opf
+IMAGE_MEDIA_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
 
 def load_config():
     """Load configuration from config.yaml file."""
     with open("config.yaml", "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=YamlLoader)
     return config
 
 
@@ -57,16 +90,37 @@ def ensure_directory(directory_path):
     Path(directory_path).mkdir(parents=True, exist_ok=True)
 
 
-def get_pdf_page_count(pdf_path):
-    """Get the total number of pages in a PDF file."""
-    with fitz.open(pdf_path) as pdf:
-        return len(pdf)
+class ProgressTracker:
+    """Keep generation progress in memory and write it to disk only when flushed."""
+
+    def __init__(self, progress_file, progress):
+        self.progress_file = progress_file
+        self.progress = progress
+        self.dirty = False
+
+    def set(self, key, value):
+        """Update a progress field without writing it yet."""
+        self.progress[key] = value
+        self.dirty = True
+
+    def mark_dirty(self):
+        """Record that the progress dict was modified in place."""
+        self.dirty = True
+
+    def flush(self, pretty=False):
+        """Write the progress file if anything changed since the last flush."""
+        if self.dirty:
+            save_generation_progress(self.progress_file, self.progress, pretty=pretty)
+            self.dirty = False
 
 
-def save_generation_progress(progress_file, progress_data):
-    """Save generation progress to a JSON file."""
-    with open(progress_file, "w", encoding="utf-8") as f:
-        json.dump(progress_data, f, indent=2)
+def save_generation_progress(progress_file, progress_data, *, pretty=False):
+    """Save generation progress to a JSON file, compact unless pretty is set."""
+    # Write to a temporary file and rename it, so an interrupted save never
+    # leaves a truncated progress file behind
+    temp_file = Path(progress_file).with_suffix(".json.tmp")
+    temp_file.write_bytes(json_dumps(progress_data, indent=pretty))
+    os.replace(temp_file, progress_file)
 
 
 def load_generation_progress(progress_file, structure=None):
@@ -88,6 +142,8 @@ def load_generation_progress(progress_file, structure=None):
         "processed_chapters": [],
         "last_processed_chapter_index": -1,
         "cover_image_filename": "",
+        "cover_width": None,
+        "cover_height": None,
         "chapter_titles": [],
     }
     
@@ -104,40 +160,63 @@ def load_generation_progress(progress_file, structure=None):
     return progress
 
 
+def iter_html_files(root):
+    """Yield the paths of all .html files under root, walking with os.scandir."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".html") and entry.is_file():
+                    yield entry.path
+
+
 def clean_unused_images(epub_dir):
     """Remove images that aren't referenced in any HTML file."""
     logger.info("Cleaning unused images...")
     # Get all image files
-    all_images = set()
-    for img_path in Path(epub_dir).glob("images/*.*"):
-        all_images.add(img_path.name)
+    with os.scandir(Path(epub_dir) / "images") as it:
+        all_images = {entry.name for entry in it if entry.is_file()}
     
-    # Find referenced images in all HTML files
+    # Find referenced images in all HTML files, matching on the raw bytes
     referenced_images = set()
-    for html_file in Path(epub_dir).glob("**/*.html"):
-        with open(html_file, "r", encoding="utf-8") as f:
-            content = f.read()
-            # Find all image references
-            img_refs = re.findall(r'<img src="\.\.\/images\/([^"]+)"', content)
-            referenced_images.update(img_refs)
+    for html_path in iter_html_files(epub_dir):
+        with open(html_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue  # mmap can't map an empty file
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                referenced_images.update(m.decode("utf-8") for m in IMG_SRC_RE.findall(mm))
+            finally:
+                mm.close()
     
     # Add cover image to referenced images (it's always used)
     cover_path = Path(epub_dir) / "content.opf"
     if cover_path.exists():
-        with open(cover_path, "r", encoding="utf-8") as f:
-            content = f.read()
-            cover_match = re.search(r'<item href="([^"]+)" id="cover"', content)
-            if cover_match and not cover_match.group(1).startswith("images/"):
-                # If it's a direct reference to the cover image
-                referenced_images.add(cover_match.group(1))
+        try:
+            for _, elem in iterparse(cover_path, events=("start",)):
+                if elem.tag == OPF_ITEM_TAG and elem.get("id") == "cover":
+                    href = elem.get("href", "")
+                    if not href.startswith("images/"):
+                        # If it's a direct reference to the cover image
+                        referenced_images.add(href)
+                    break
+                elem.clear()
+        except ParseError as e:
+            logger.warning(f"Could not parse {cover_path} for the cover reference: {e}")
     
     # Also check titlepage.xhtml for cover image references
     cover_page_path = Path(epub_dir) / "titlepage.xhtml"
     if cover_page_path.exists():
-        with open(cover_page_path, "r", encoding="utf-8") as f:
-            content = f.read()
-            cover_matches = re.findall(r'xlink:href="([^"]+)"', content)
-            referenced_images.update(cover_matches)
+        try:
+            for _, elem in iterparse(cover_page_path, events=("start",)):
+                if elem.tag == SVG_IMAGE_TAG and elem.get(XLINK_HREF):
+                    referenced_images.add(elem.get(XLINK_HREF))
+                    break
+                elem.clear()
+        except ParseError as e:
+            logger.warning(f"Could not parse {cover_page_path} for the cover reference: {e}")
     
     # Find unused images
     unused_images = all_images - referenced_images
@@ -156,8 +235,8 @@ def clean_unused_images(epub_dir):
 
 def create_toc_ncx(structure, book_title, book_uuid, output_path):
     """Create the toc.ncx file for EPUB navigation."""
-    # Start building the NCX content
-    ncx_content = f"""<?xml version='1.0' encoding='utf-8'?>
+    # Start building the NCX content; parts are joined once at the end
+    parts = [f"""<?xml version='1.0' encoding='utf-8'?>
 <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1" xml:lang="jpn">
   <head>
     <meta content="{book_uuid}" name="dtb:uid"/>
@@ -181,7 +260,7 @@ def create_toc_ncx(structure, book_title, book_uuid, output_path):
         <text>目次</text>
       </navLabel>
       <content src="text/toc.html"/>
-    </navPoint>"""
+    </navPoint>"""]
 
     # Add chapters to the NCX
     play_order = 3
@@ -189,68 +268,60 @@ def create_toc_ncx(structure, book_title, book_uuid, output_path):
         chapter_id = f"chapter_{i}"
         chapter_filename = f"chapter_{i}.html"
 
-        ncx_content += f"""
+        parts.append(f"""
     <navPoint class="chapter" id="{chapter_id}" playOrder="{play_order}">
       <navLabel>
         <text>{chapter['title']}</text>
       </navLabel>
       <content src="text/{chapter_filename}"/>
-    </navPoint>"""
+    </navPoint>""")
         play_order += 1
 
     # Close the NCX file
-    ncx_content += """
+    parts.append("""
   </navMap>
-</ncx>"""
+</ncx>""")
 
     # Write the NCX file
-    with open(output_path, "w", encoding="utf-8") as ncx_file:
-        ncx_file.write(ncx_content)
+    Path(output_path).write_text("".join(parts), encoding="utf-8")
 
     logger.info(f"Created toc.ncx at {output_path}")
 
 
 def extract_cover_image(pdf_path, output_dir):
-    """Extract the cover image from the PDF."""
+    """
+    Extract the cover image from the PDF, returning (filename, width, height).
+
+    If the cover image can't be extracted the filename is empty and the size is
+    0x0, so the result can still be recorded as done.
+    """
     doc = fitz.open(pdf_path)
     cover_page = doc[0]  # First page is the cover
 
-    # Get list of image objects in the cover page
-    image_list = cover_page.get_images(full=True)
+    # Get size and xref of the images on the cover page without decoding them
+    image_infos = [info for info in cover_page.get_image_info(xrefs=True) if info["xref"]]
 
     # If no images found, save the whole page as an image
-    if not image_list:
+    if not image_infos:
         pix = cover_page.get_pixmap(matrix=fitz.Matrix(2, 2))  # Higher resolution
         image_path = os.path.join(output_dir, "cover.jpeg")
         pix.save(image_path)
-        return "cover.jpeg"
+        return "cover.jpeg", pix.width, pix.height
 
-    # Otherwise, extract the largest image as the cover
-    largest_image = None
-    max_size = 0
+    # Otherwise, extract the largest image as the cover; only that one is decoded
+    largest_info = max(image_infos, key=lambda info: info["width"] * info["height"])
+    base_image = doc.extract_image(largest_info["xref"])
 
-    for img_index, img in enumerate(image_list):
-        xref = img[0]
-        base_image = doc.extract_image(xref)
+    if base_image:
         image_bytes = base_image["image"]
         image_ext = base_image["ext"]
         width = base_image["width"]
         height = base_image["height"]
 
-        image_size = width * height
-        if image_size > max_size:
-            max_size = image_size
-            largest_image = (img_index, image_bytes, image_ext)
-
-    if largest_image:
-        img_index, image_bytes, image_ext = largest_image
         # Always save as JPEG for better compatibility
         if image_ext.lower() != "jpeg" and image_ext.lower() != "jpg":
             # Convert to JPEG if it's not already
-            img = Image.open(BytesIO(image_bytes))
-            img_buffer = BytesIO()
-            img.convert("RGB").save(img_buffer, format="JPEG", quality=95)
-            image_bytes = img_buffer.getvalue()
+            image_bytes = to_jpeg_bytes(image_bytes, image_ext)
             image_ext = "jpeg"
 
         image_filename = f"cover.{image_ext}"
@@ -259,79 +330,42 @@ def extract_cover_image(pdf_path, output_dir):
         with open(image_path, "wb") as img_file:
             img_file.write(image_bytes)
 
-        return image_filename
+        return image_filename, width, height
 
-    return None
+    logger.warning("Could not extract the cover image, using a text titlepage")
+    return "", 0, 0
 
 
-def extract_images_from_pdf_page(pdf_doc, page_num, images_dir, chapter_index, base_counter=1):
-    """Extract meaningful images from a specific PDF page with improved filtering."""
-    page = pdf_doc[page_num]
-    image_list = page.get_images(full=True)
-    extracted_images = []
-    
-    counter = base_counter
-    for img_index, img in enumerate(image_list):
-        xref = img[0]
-        base_image = pdf_doc.extract_image(xref)
-        
-        # More aggressively filter small images and better detect full-page text
-        width = base_image["width"]
-        height = base_image["height"]
-        
-        # Skip very small images (likely icons or decorations)
-        if width < 100 or height < 100:
-            continue
-        
-        # Skip images that are likely full-page text
-        # This heuristic looks at image dimensions compared to page dimensions
-        page_width, page_height = page.rect.width, page.rect.height
-        if (width > 0.9 * page_width and height > 0.9 * page_height):
-            # This might be a full page scan - skip unless it's actually an image
-            continue
-            
-        image_bytes = base_image["image"]
-        image_ext = base_image["ext"]
-        
-        # Convert to JPEG for compatibility
-        if image_ext.lower() not in ["jpeg", "jpg"]:
-            try:
-                img_obj = Image.open(BytesIO(image_bytes))
-                img_buffer = BytesIO()
-                img_obj.convert("RGB").save(img_buffer, format="JPEG", quality=95)
-                image_bytes = img_buffer.getvalue()
-                image_ext = "jpg"
-            except Exception as e:
-                logger.error(f"Error converting image: {e}")
-                continue
-        
-        image_filename = f"chapter_{chapter_index}_img_{counter}.{image_ext}"
-        image_path = os.path.join(images_dir, image_filename)
-        
-        with open(image_path, "wb") as img_file:
-            img_file.write(image_bytes)
-        
-        extracted_images.append({
-            "filename": image_filename,
-            "path": image_path,
-            "page": page_num,
-            "width": width,
-            "height": height
-        })
-        
-        counter += 1
-    
-    return extracted_images, counter
+def get_image_executor():
+    """Return the process pool used for image extraction, starting it on first use."""
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is None:
+            # Chapter threads are running, so start workers with spawn rather than fork
+            _image_executor = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _image_executor
 
 
-def create_cover_html(cover_image_filename, book_title, output_path):
-    """Create XHTML file for the cover."""
-    # Get image dimensions
-    try:
-        with Image.open(Path(output_path).parent / cover_image_filename) as img:
-            width, height = img.size
-    except Exception:
-        width, height = 600, 800  # Default dimensions if unable to get actual size
+def shutdown_image_executor():
+    """Stop the image extraction workers, if they were started."""
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is not None:
+            _image_executor.shutdown()
+            _image_executor = None
+
+
+def create_cover_html(cover_image_filename, book_title, output_path, cover_width, cover_height):
+    """Create XHTML file for the cover, using the dimensions recorded at extraction."""
+    if cover_image_filename:
+        cover_body = f"""<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" width="100%" height="100%" viewBox="0 0 {cover_width} {cover_height}" preserveAspectRatio="none">
+                <image width="{cover_width}" height="{cover_height}" xlink:href="{cover_image_filename}"/>
+            </svg>"""
+    else:
+        # No cover image was found, so the titlepage shows the book title instead
+        cover_body = f"<h1>{escape(book_title)}</h1>"
 
     cover_html = f"""<?xml version='1.0' encoding='utf-8'?>
 <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="ja">
@@ -346,9 +380,7 @@ def create_cover_html(cover_image_filename, book_title, output_path):
     </head>
     <body>
         <div>
-            <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" width="100%" height="100%" viewBox="0 0 {width} {height}" preserveAspectRatio="none">
-                <image width="{width}" height="{height}" xlink:href="{cover_image_filename}"/>
-            </svg>
+            {cover_body}
         </div>
     </body>
 </html>"""
@@ -359,28 +391,26 @@ def create_cover_html(cover_image_filename, book_title, output_path):
     logger.info(f"Created cover XHTML at {output_path}")
 
 
-def create_toc_html(structure, book_title, output_path, client, pdf_path, config):
+def create_toc_html(structure, book_title, output_path, client, pdf_doc, config):
     """Create HTML file for the table of contents using Gemini."""
     # Get TOC page range from the structure
     toc_start = structure["table_of_contents"]["start_page"]
     toc_end = structure["table_of_contents"]["end_page"]
     
-    # Extract only the TOC pages from the PDF
-    with fitz.open(pdf_path) as full_pdf:
+    # Extract only the TOC pages from the already opened PDF
+    with PDF_LOCK:
         # Create a new PDF with just the TOC pages
         toc_pdf = fitz.open()
-        for page_num in range(toc_start - 1, toc_end):  # Convert to 0-based indexing
-            if page_num < len(full_pdf):  # Ensure we don't go out of bounds
-                toc_pdf.insert_pdf(full_pdf, from_page=page_num, to_page=page_num)
-        
-        # Save to a temporary file
-        temp_pdf_path = Path(output_path).parent / "temp_toc.pdf"
-        toc_pdf.save(temp_pdf_path)
-        toc_pdf.close()
-    
-    # Load only the TOC PDF
-    with open(temp_pdf_path, "rb") as f:
-        pdf_data = f.read()
+        last_page = min(toc_end, len(pdf_doc))  # Ensure we don't go out of bounds
+        if toc_start <= last_page:
+            # Convert to 0-based indexing; the range is copied in a single call
+            toc_pdf.insert_pdf(pdf_doc, from_page=toc_start - 1, to_page=last_page - 1)
+
+    # Serialize the TOC pages in memory rather than through a temporary file.
+    # The new document no longer references the shared one, so this runs
+    # outside the lock.
+    pdf_data = toc_pdf.tobytes(garbage=3, deflate=True)
+    toc_pdf.close()
     
     prompt = f"""
     Create an HTML file for the table of contents of this book "{book_title}".
@@ -399,6 +429,7 @@ def create_toc_html(structure, book_title, output_path, client, pdf_path, config
     """
     
     # Create parts for the multimodal input - text and PDF data
+    from google.genai.types import Part
     parts = [
         prompt,
         Part.from_bytes(data=pdf_data, mime_type="application/pdf"),
@@ -411,19 +442,16 @@ def create_toc_html(structure, book_title, output_path, client, pdf_path, config
     num_retries = config.get("num_retries", 3)
     max_backoff = config.get("max_backoff_seconds", 30)
     
-    # Get default generation config
-    generation_config = get_default_generation_config(temperature=0.1)
-    generation_config.response_mime_type = "application/xml"
-    
     response = generate_content_with_retry(
         client=client,
         model=model,
         contents=parts,
-        config=generation_config,
+        config=get_default_generation_config(temperature=0.1, response_mime_type="application/xml"),
         max_retries=num_retries,
         max_backoff=max_backoff,
         operation_name="TOC HTML generation",
-        use_streaming=True
+        use_streaming=True,
+        stop_marker="</html>",
     )
     
     # Clean the HTML response
@@ -436,12 +464,6 @@ def create_toc_html(structure, book_title, output_path, client, pdf_path, config
     with open(output_path, "w", encoding="utf-8") as html_file:
         html_file.write(html_content)
     
-    # Clean up temporary PDF
-    try:
-        os.remove(temp_pdf_path)
-    except Exception as e:
-        logger.warning(f"Could not remove temporary TOC PDF: {e}")
-    
     logger.info(f"Created TOC HTML at {output_path}")
 
 
@@ -452,15 +474,15 @@ def create_chapter_html(
     book_title,
     output_path,
     client,
-    pdf_path,
+    pdf_doc,
+    total_pages,
     images_dir,
-    previous_chapters,
     config,
 ):
     """Create HTML file for a chapter using Gemini with simplified image handling."""
     # Get chapter page range with buffer (3 pages before and after)
     start_page = max(1, chapter["start_page"] - 3)  # Don't go below page 1
-    end_page = min(chapter["end_page"] + 3, get_pdf_page_count(pdf_path))  # Don't exceed PDF length
+    end_page = min(chapter["end_page"] + 3, total_pages)  # Don't exceed PDF length
     
     # Original chapter bounds for the prompt
     actual_start = chapter["start_page"]
@@ -468,21 +490,18 @@ def create_chapter_html(
     chapter_title = chapter["title"]
 
     # Extract only the pages we need from the PDF
-    with fitz.open(pdf_path) as full_pdf:
+    with PDF_LOCK:
         # Create a new PDF with just the chapter pages plus buffer
         chapter_pdf = fitz.open()
-        for page_num in range(start_page - 1, end_page):  # Convert to 0-based indexing
-            if page_num < len(full_pdf):  # Ensure we don't go out of bounds
-                chapter_pdf.insert_pdf(full_pdf, from_page=page_num, to_page=page_num)
-        
-        # Save to a temporary file
-        temp_pdf_path = Path(output_path).parent / f"temp_chapter_{chapter_index}.pdf"
-        chapter_pdf.save(temp_pdf_path)
-        chapter_pdf.close()
-    
-    # Load only the chapter PDF
-    with open(temp_pdf_path, "rb") as f:
-        pdf_data = f.read()
+        if start_page <= end_page:
+            # Convert to 0-based indexing; the range is copied in a single call
+            chapter_pdf.insert_pdf(pdf_doc, from_page=start_page - 1, to_page=end_page - 1)
+
+    # Serialize the chapter pages in memory rather than through a temporary file.
+    # The new document no longer references the shared one, so this runs
+    # outside the lock.
+    pdf_data = chapter_pdf.tobytes(garbage=3, deflate=True)
+    chapter_pdf.close()
 
     prompt = f"""
     Convert the chapter "{chapter_title}" from the book "{book_title}" into clean HTML format.
@@ -608,6 +627,7 @@ def create_chapter_html(
     """
 
     # Create parts for the multimodal input - text and PDF data
+    from google.genai.types import Part
     parts = [
         prompt,
         Part.from_bytes(data=pdf_data, mime_type="application/pdf"),
@@ -620,19 +640,16 @@ def create_chapter_html(
     num_retries = config.get("num_retries", 3)
     max_backoff = config.get("max_backoff_seconds", 30)
     
-    # Get default generation config
-    generation_config = get_default_generation_config(temperature=0.1)
-    generation_config.response_mime_type = "application/xml"
-    
     response = generate_content_with_retry(
         client=client,
         model=model,
         contents=parts,
-        config=generation_config,
+        config=get_default_generation_config(temperature=0.1, response_mime_type="application/xml"),
         max_retries=num_retries,
         max_backoff=max_backoff,
         operation_name=f"Chapter {chapter_index} HTML generation",
-        use_streaming=True
+        use_streaming=True,
+        stop_marker="</html>",
     )
     
     # Clean the HTML response
@@ -641,76 +658,48 @@ def create_chapter_html(
     if html_content is None:
         raise ValueError(f"Failed to generate chapter {chapter_index} HTML after {num_retries} attempts")
     
+    # Find all image placeholders in the HTML
+    placeholder_matches = list(IMAGE_PLACEHOLDER_RE.finditer(html_content))
+    
     # Process image placeholders
-    with fitz.open(temp_pdf_path) as chapter_pdf:
-        image_counter = 1
-        
-        # Find all image placeholders in the HTML
-        placeholder_matches = re.finditer(r'<div class="image-placeholder" id="([^"]+)" data-page="(\d+)" data-description="([^"]+)"></div>', html_content)
+    if placeholder_matches:
+        images = get_image_executor().submit(
+            extract_placeholder_images,
+            pdf_data,
+            [int(match.group(2)) for match in placeholder_matches],
+            chapter_index,
+        ).result()
         
-        for match in placeholder_matches:
-            # img_id = match.group(1)
-            relative_page = int(match.group(2))
-            description = match.group(3)
-            
-            # Calculate the actual page in the PDF
-            actual_page = min(relative_page, len(chapter_pdf) - 1)
-            
-            # Extract images from this page
-            extracted_images, _ = extract_images_from_pdf_page(
-                chapter_pdf, actual_page, images_dir, chapter_index, image_counter
-            )
-            
-            # If images were found, replace the placeholder with an actual image tag
-            if extracted_images:
-                img = extracted_images[0]  # Use the first extracted image
-                img_tag = f'<img src="../images/{img["filename"]}" alt="{description}" class="chapter-image" />'
+        for match, image in zip(placeholder_matches, images):
+            # If images were found, write the one used and replace the placeholder with an image tag
+            if image:
+                image_filename, image_bytes = image
+                Path(images_dir, image_filename).write_bytes(image_bytes)
+                description = match.group(3)
+                img_tag = f'<img src="../images/{image_filename}" alt="{description}" class="chapter-image" />'
                 placeholder = match.group(0)
                 html_content = html_content.replace(placeholder, img_tag)
-                image_counter += 1
 
-    # Write the HTML to the output file
-    with open(output_path, "w", encoding="utf-8") as html_file:
-        html_file.write(html_content)
-    
-    # Clean up temporary PDF
-    try:
-        os.remove(temp_pdf_path)
-    except Exception as e:
-        logger.warning(f"Could not remove temporary PDF: {e}")
+    # Write the HTML to the output file; it is kept on disk so interrupted runs can resume
+    html_bytes = html_content.encode("utf-8")
+    Path(output_path).write_bytes(html_bytes)
 
     logger.info(f"Created Chapter {chapter_index} HTML at {output_path}")
-    return chapter_title
+    return chapter_title, html_bytes
 
 
 def create_container_xml(output_path):
     """Create the META-INF/container.xml file."""
-    container_xml = """<?xml version="1.0"?>
-<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
-   <rootfiles>
-      <rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
-   </rootfiles>
-</container>"""
-
-    with open(output_path, "w", encoding="utf-8") as xml_file:
-        xml_file.write(container_xml)
+    Path(output_path).write_bytes(CONTAINER_XML_BYTES)
 
 
 def create_mimetype(output_path):
     """Create the mimetype file."""
-    with open(output_path, "w", encoding="utf-8") as mimetype_file:
-        mimetype_file.write("application/epub+zip")
+    Path(output_path).write_bytes(MIMETYPE_BYTES)
 
 
-def create_content_opf(
-    book_title, book_uuid, author, chapters, cover_filename, output_path, epub_dir
-):
-    """Create the content.opf file."""
-    # Get current timestamp in ISO format
-    timestamp = datetime.now().isoformat(timespec="seconds")
-
-    # Start building the OPF content
-    opf_content = f"""<?xml version='1.0' encoding='utf-8'?>
+# content.opf skeleton; the chapter and image entries are rendered into it in one pass
+OPF_TEMPLATE = """<?xml version='1.0' encoding='utf-8'?>
 <package xmlns="http://www.idpf.org/2007/opf" unique-identifier="uuid_id" version="2.0">
   <metadata xmlns:calibre="http://calibre.kovidgoyal.net/2009/metadata" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" xmlns:opf="http://www.idpf.org/2007/opf" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
     <dc:date>{timestamp}</dc:date>
@@ -720,49 +709,19 @@ def create_content_opf(
     <dc:language>ja</dc:language>
     <dc:contributor opf:role="bkp">calibre (4.23.0) [https://calibre-ebook.com]</dc:contributor>
     <meta name="calibre:title_sort" content="{book_title}"/>
-    <meta name="cover" content="cover"/>
-    <dc:creator opf:file-as="{author}" opf:role="aut">{author}</dc:creator>
+{cover_metadata}    <dc:creator opf:file-as="{author}" opf:role="aut">{author}</dc:creator>
     <meta name="calibre:timestamp" content="{timestamp}+00:00"/>
   </metadata>
   <manifest>
-    <item href="{cover_filename}" id="cover" media-type="image/jpeg"/>
-    <item href="titlepage.xhtml" id="titlepage" media-type="application/xhtml+xml"/>
+{cover_manifest}    <item href="titlepage.xhtml" id="titlepage" media-type="application/xhtml+xml"/>
     <item href="text/toc.html" id="toc" media-type="application/xhtml+xml"/>
-"""
-
-    # Add chapters to manifest
-    for i in range(1, len(chapters) + 1):
-        opf_content += f'    <item href="text/chapter_{i}.html" id="chapter_{i}" media-type="application/xhtml+xml"/>\n'
-
-    # Add images to manifest
-    image_id = 1
-    for image_file in Path(epub_dir).glob("images/*.jpg"):
-        opf_content += f'    <item href="images/{image_file.name}" id="img_{image_id}" media-type="image/jpeg"/>\n'
-        image_id += 1
-
-    for image_file in Path(epub_dir).glob("images/*.jpeg"):
-        opf_content += f'    <item href="images/{image_file.name}" id="img_{image_id}" media-type="image/jpeg"/>\n'
-        image_id += 1
-
-    for image_file in Path(epub_dir).glob("images/*.png"):
-        opf_content += f'    <item href="images/{image_file.name}" id="img_{image_id}" media-type="image/png"/>\n'
-        image_id += 1
-
-    # Add remaining required items
-    opf_content += """    <item href="stylesheet.css" id="css" media-type="text/css"/>
+{manifest}    <item href="stylesheet.css" id="css" media-type="text/css"/>
     <item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>
   </manifest>
   <spine toc="ncx" page-progression-direction="rtl">
     <itemref idref="titlepage"/>
     <itemref idref="toc"/>
-"""
-
-    # Add chapters to spine
-    for i in range(1, len(chapters) + 1):
-        opf_content += f'    <itemref idref="chapter_{i}"/>\n'
-
-    # Close spine and add guide
-    opf_content += """  </spine>
+{spine}  </spine>
   <guide>
     <reference href="text/toc.html" title="目次" type="toc"/>
     <reference href="titlepage.xhtml" title="Cover" type="cover"/>
@@ -770,14 +729,50 @@ def create_content_opf(
   </guide>
 </package>"""
 
-    # Write the OPF file
-    with open(output_path, "w", encoding="utf-8") as opf_file:
-        opf_file.write(opf_content)
 
+def create_content_opf(
+    book_title, book_uuid, author, chapters, cover_filename, output_path, epub_dir
+):
+    """Create the content.opf file."""
+    # Get current timestamp in ISO format
+    timestamp = datetime.now().isoformat(timespec="seconds")
+
+    # Add chapters to manifest
+    manifest_lines = [
+        f'    <item href="text/chapter_{i}.html" id="chapter_{i}" media-type="application/xhtml+xml"/>\n'
+        for i in range(1, len(chapters) + 1)
+    ]
 
-def create_stylesheet(output_path):
-    """Create a basic CSS stylesheet."""
-    css_content = """@namespace h "http://www.w3.org/1999/xhtml";
+    # Add images to manifest, listing the images directory once; sorting keeps
+    # the image IDs stable across rebuilds
+    with os.scandir(Path(epub_dir) / "images") as it:
+        image_names = sorted(entry.name for entry in it if os.path.splitext(entry.name)[1] in IMAGE_MEDIA_TYPES)
+    for image_id, name in enumerate(image_names, 1):
+        media_type = IMAGE_MEDIA_TYPES[os.path.splitext(name)[1]]
+        manifest_lines.append(f'    <item href="images/{name}" id="img_{image_id}" media-type="{media_type}"/>\n')
+
+    # Add chapters to spine
+    spine_lines = [f'    <itemref idref="chapter_{i}"/>\n' for i in range(1, len(chapters) + 1)]
+
+    # Write the OPF file
+    opf_content = OPF_TEMPLATE.format_map({
+        "timestamp": timestamp,
+        "book_title": book_title,
+        "book_uuid": book_uuid,
+        "author": author,
+        # Books without a cover image have no cover item to point at
+        "cover_metadata": '    <meta name="cover" content="cover"/>\n' if cover_filename else "",
+        "cover_manifest": (
+            f'    <item href="{cover_filename}" id="cover" media-type="image/jpeg"/>\n' if cover_filename else ""
+        ),
+        "manifest": "".join(manifest_lines),
+        "spine": "".join(spine_lines),
+    })
+    Path(output_path).write_text(opf_content, encoding="utf-8")
+
+
+# Stylesheet shared by every generated book, encoded once at import
+STYLESHEET = """@namespace h "http://www.w3.org/1999/xhtml";
 body {
     font-family: "Hiragino Mincho ProN", "MS Mincho", serif;
     line-height: 1.8;
@@ -876,40 +871,58 @@ sup a:hover {
 .inline-note { /* For things like ビルドゥングスロマン */
     font-size: 0.85em;
 }"""
+STYLESHEET_BYTES = STYLESHEET.encode("utf-8")
 
-    with open(output_path, "w", encoding="utf-8") as css_file:
-        css_file.write(css_content)
 
+def create_stylesheet(output_path):
+    """Create a basic CSS stylesheet."""
+    Path(output_path).write_bytes(STYLESHEET_BYTES)
+
+
+def build_epub_archive(epub_dir, out_path, contents=None):
+    """
+    Zip the contents of epub_dir into an EPUB archive in a single pass.
 
-def create_epub(book_title, epub_dir):
-    """Create an EPUB file by zipping the contents."""
+    The mimetype entry is written first and uncompressed as the EPUB spec requires,
+    and images are stored without recompression, which leaves the maximum deflate
+    level affordable for the text entries. Entries found in contents (a
+    dict of arcname to bytes) are written from memory instead of read back from disk.
+    """
+    contents = contents or {}
+    with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zipf:
+        zipf.writestr(zipfile.ZipInfo("mimetype"), MIMETYPE_BYTES, compress_type=zipfile.ZIP_STORED)
+
+        # Arcnames are built by string concatenation while walking, with no Path objects
+        stack = [(os.fspath(epub_dir), "")]
+        while stack:
+            folder, prefix = stack.pop()
+            with os.scandir(folder) as it:
+                for entry in it:
+                    arcname = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, arcname + "/"))
+                    elif arcname in contents:
+                        zipf.writestr(arcname, contents[arcname], compress_type=zipfile.ZIP_DEFLATED)
+                    elif arcname != "mimetype":
+                        if entry.name.lower().endswith(STORED_EXTENSIONS):
+                            compress_type = zipfile.ZIP_STORED
+                        else:
+                            compress_type = zipfile.ZIP_DEFLATED
+                        zipf.write(entry.path, arcname, compress_type=compress_type)
+
+
+def create_epub(book_title, epub_dir, contents=None):
+    """Create an EPUB file by zipping the contents, taking any in-memory files from contents."""
     output_epub = Path("output") / Path(book_title) / f"{book_title}.epub"
 
-    # Create a temporary zip file
-    temp_zip = Path("output") / Path(book_title) / "temp.zip"
+    # Write next to the final file so the rename below never crosses filesystems
+    temp_epub = output_epub.with_suffix(".epub.tmp")
 
     # Create the EPUB zip file
-    with zipfile.ZipFile(temp_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
-        # First add the mimetype file (must be uncompressed)
-        zipf.write(epub_dir / "mimetype", "mimetype", compress_type=zipfile.ZIP_STORED)
-
-        # Add all other files
-        for folder_name, subfolders, filenames in os.walk(epub_dir):
-            folder_path = Path(folder_name)
-            relative_path = folder_path.relative_to(epub_dir)
-
-            # Skip mimetype as it's already added
-            if str(relative_path) == "." and "mimetype" in filenames:
-                filenames.remove("mimetype")
-
-            # Add all files in the current folder
-            for filename in filenames:
-                file_path = folder_path / filename
-                arcname = Path(relative_path) / filename
-                zipf.write(file_path, arcname)
-
-    # Rename the zip file to epub
-    shutil.move(temp_zip, output_epub)
+    build_epub_archive(epub_dir, temp_epub, contents)
+
+    # Atomically replace any previous EPUB
+    os.replace(temp_epub, output_epub)
     logger.success(f"Created EPUB at {output_epub}")
     return output_epub
 
@@ -929,7 +942,7 @@ def main():
 
     # Load configuration
     with open(args.config, "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=YamlLoader)
     api_key = config.get("google_api_key")
     book_title = config.get("title")
     author = config.get("author")
@@ -975,6 +988,12 @@ def main():
         progress = load_generation_progress(progress_file, structure)
         progress["book_uuid"] = book_uuid
 
+    # Setup steps only update progress in memory; it is written once they are done
+    # and again after each chapter
+    tracker = ProgressTracker(progress_file, progress)
+    if not resuming:
+        tracker.mark_dirty()
+
     # Ensure directories exist
     ensure_directory(epub_dir)
     ensure_directory(images_dir)
@@ -984,67 +1003,74 @@ def main():
     # Path to the PDF file
     pdf_path = Path(args.input)
 
+    # Open the PDF once; the TOC and every chapter slice their pages from this handle
+    pdf_doc = fitz.open(pdf_path)
+    total_pages = len(pdf_doc)
+
     # Create the mimetype file if not already done
     if not progress["mimetype_created"]:
         create_mimetype(epub_dir / "mimetype")
-        progress["mimetype_created"] = True
-        save_generation_progress(progress_file, progress)
+        tracker.set("mimetype_created", True)
     else:
         logger.info("Skipping mimetype creation (already done)")
 
     # Create the container.xml file if not already done
     if not progress["container_xml_created"]:
         create_container_xml(meta_inf_dir / "container.xml")
-        progress["container_xml_created"] = True
-        save_generation_progress(progress_file, progress)
+        tracker.set("container_xml_created", True)
     else:
         logger.info("Skipping container.xml creation (already done)")
 
     # Extract and save the cover image if not already done
     cover_image_filename = progress["cover_image_filename"]
-    if not progress["cover_extracted"]:
-        cover_image_filename = extract_cover_image(pdf_path, epub_dir)
-        progress["cover_image_filename"] = cover_image_filename
-        progress["cover_extracted"] = True
-        save_generation_progress(progress_file, progress)
+    # Progress files from older runs don't record the cover size, so extract it again;
+    # a cover without an image is recorded with a 0x0 size
+    if not progress["cover_extracted"] or progress.get("cover_width") is None:
+        cover_image_filename, cover_width, cover_height = extract_cover_image(pdf_path, epub_dir)
+        tracker.set("cover_image_filename", cover_image_filename)
+        tracker.set("cover_width", cover_width)
+        tracker.set("cover_height", cover_height)
+        tracker.set("cover_extracted", True)
     else:
         logger.info(f"Skipping cover extraction (already done): {cover_image_filename}")
 
     # Create the titlepage XHTML if not already done
     if not progress["cover_html_created"]:
-        create_cover_html(cover_image_filename, book_title, epub_dir / "titlepage.xhtml")
-        progress["cover_html_created"] = True
-        save_generation_progress(progress_file, progress)
+        create_cover_html(
+            cover_image_filename,
+            book_title,
+            epub_dir / "titlepage.xhtml",
+            progress["cover_width"],
+            progress["cover_height"],
+        )
+        tracker.set("cover_html_created", True)
     else:
         logger.info("Skipping cover HTML creation (already done)")
 
     # Create the stylesheet if not already done
     if not progress["stylesheet_created"]:
         create_stylesheet(epub_dir / "stylesheet.css")
-        progress["stylesheet_created"] = True
-        save_generation_progress(progress_file, progress)
+        tracker.set("stylesheet_created", True)
     else:
         logger.info("Skipping stylesheet creation (already done)")
 
     # Create the toc.ncx file if not already done
     if not progress["toc_ncx_created"]:
         create_toc_ncx(structure, book_title, book_uuid, epub_dir / "toc.ncx")
-        progress["toc_ncx_created"] = True
-        save_generation_progress(progress_file, progress)
+        tracker.set("toc_ncx_created", True)
     else:
         logger.info("Skipping toc.ncx creation (already done)")
 
     # Create HTML for the table of contents if not already done
     toc_html_path = text_dir / "toc.html"
     if not progress["toc_html_created"]:
-        create_toc_html(structure, book_title, toc_html_path, client, pdf_path, config)
-        progress["toc_html_created"] = True
-        save_generation_progress(progress_file, progress)
+        create_toc_html(structure, book_title, toc_html_path, client, pdf_doc, config)
+        tracker.set("toc_html_created", True)
     else:
         logger.info("Skipping TOC HTML creation (already done)")
+    tracker.flush()
 
     # Process each chapter
-    previous_chapters = []
     chapter_titles = progress["chapter_titles"]
     
     # Ensure chapters array exists in progress
@@ -1056,68 +1082,105 @@ def main():
                 "title": chapter["title"],
                 "generated": False
             })
-        save_generation_progress(progress_file, progress)
+        tracker.mark_dirty()
+
+    # Index the chapter entries by chapter number for direct lookups
+    chapters_by_index = {ch["index"]: ch for ch in progress["chapters"]}
 
+    # Collect the chapters that still need to be generated
+    pending_chapters = []
     for i, chapter in enumerate(structure["chapters"], 1):
         # Check if chapter is already processed
         chapter_processed = False
         if i <= progress["last_processed_chapter_index"]:
             # For backward compatibility
             chapter_processed = True
-        elif "chapters" in progress:
-            # Find the chapter in the chapters array
-            for ch in progress["chapters"]:
-                if ch["index"] == i and ch["generated"]:
-                    chapter_processed = True
-                    break
+        elif i in chapters_by_index:
+            chapter_processed = chapters_by_index[i]["generated"]
         
         if chapter_processed:
             logger.info(f"Skipping chapter {i} (already processed)")
-            # Load the chapter content for context
-            chapter_html_path = text_dir / f"chapter_{i}.html"
-            if chapter_html_path.exists():
-                with open(chapter_html_path, "r", encoding="utf-8") as f:
-                    chapter_content = f.read()
-                    previous_chapters.append(chapter_content)
             continue
 
-        chapter_html_path = text_dir / f"chapter_{i}.html"
-        chapter_title = create_chapter_html(
-            chapter,
-            structure,
-            i,
-            book_title,
-            chapter_html_path,
-            client,
-            pdf_path,
-            images_dir,
-            previous_chapters,
-            config,
-        )
-        
-        # Update progress
-        if len(chapter_titles) < i:
-            chapter_titles.append(chapter_title)
-        else:
-            chapter_titles[i - 1] = chapter_title
-            
-        progress["chapter_titles"] = chapter_titles
-        progress["last_processed_chapter_index"] = i
-        
-        # Update the chapter's generated status in the chapters array
-        for ch in progress["chapters"]:
-            if ch["index"] == i:
-                ch["generated"] = True
-                break
-        
-        save_generation_progress(progress_file, progress)
+        pending_chapters.append((i, chapter))
+
+    # Chapters are independent, so their Gemini requests run concurrently.
+    # Progress is only updated from this thread as each chapter completes.
+    num_workers = config.get("num_workers", 5)
+    chapter_html = {}  # Chapters generated by this run, zipped without rereading them
+    first_error = None
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                executor.submit(
+                    create_chapter_html,
+                    chapter,
+                    structure,
+                    i,
+                    book_title,
+                    text_dir / f"chapter_{i}.html",
+                    client,
+                    pdf_doc,
+                    total_pages,
+                    images_dir,
+                    config,
+                ): i
+                for i, chapter in pending_chapters
+            }
 
-        # Add processed chapter to context for next chapters
-        with open(chapter_html_path, "r", encoding="utf-8") as f:
-            chapter_content = f.read()
-            previous_chapters.append(chapter_content)
-            # Save money by only keeping the most recent chapter
-            # previous_chapters = [chapter_content]
+            try:
+                for future in as_completed(futures):
+                    i = futures[future]
+                    if future.cancelled():
+                        continue
+                    try:
+                        chapter_title, html_bytes = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to generate chapter {i}: {e}")
+                        if first_error is None:
+                            first_error = e
+                            # Don't start the chapters still queued; those already
+                            # running finish and are recorded below
+                            executor.shutdown(wait=False, cancel_futures=True)
+                        continue
+
+                    # Update progress
+                    if len(chapter_titles) < i:
+                        chapter_titles.extend(
+                            ch["title"] for ch in structure["chapters"][len(chapter_titles):i]
+                        )
+                    chapter_titles[i - 1] = chapter_title
+                    chapter_html[f"text/chapter_{i}.html"] = html_bytes
+                    progress["chapter_titles"] = chapter_titles
+            
+                    # Update the chapter's generated status in the chapters array
+                    if i in chapters_by_index:
+                        chapters_by_index[i]["generated"] = True
+
+                    # Chapters finish out of order, so only advance the index over the
+                    # contiguous run of generated chapters (it marks all earlier ones done)
+                    last_index = max(progress["last_processed_chapter_index"], 0)
+                    while chapters_by_index.get(last_index + 1, {}).get("generated"):
+                        last_index += 1
+                    progress["last_processed_chapter_index"] = last_index
+            
+                    tracker.mark_dirty()
+                    tracker.flush()
+            except BaseException:
+                # Interrupted (e.g. Ctrl-C): drop the queued chapters instead of
+                # making their Gemini calls while the pool shuts down
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        # Keep whatever progress was made if a chapter raises or the run is interrupted
+        tracker.flush()
+        # Only chapters extract images, so the worker processes are no longer needed
+        shutdown_image_executor()
+
+    pdf_doc.close()
+
+    if first_error is not None:
+        raise first_error
 
     # Create the content.opf file if not already done
     if not progress["content_opf_created"]:
@@ -1130,8 +1193,8 @@ def main():
             epub_dir / "content.opf",
             epub_dir,
         )
-        progress["content_opf_created"] = True
-        save_generation_progress(progress_file, progress)
+        tracker.set("content_opf_created", True)
+        tracker.flush(pretty=True)
     else:
         logger.info("Skipping content.opf creation (already done)")
     
@@ -1139,7 +1202,7 @@ def main():
     clean_unused_images(epub_dir)
     
     # Create the final EPUB file
-    epub_path = create_epub(book_title, epub_dir)
+    epub_path = create_epub(book_title, epub_dir, chapter_html)
 
     logger.success(f"EPUB creation complete! File saved to: {epub_path}")
 
@@ -14,18 +14,35 @@ Usage:
 import os
 import sys
 import argparse
-import tempfile
-from pathlib import Path
-from PIL import Image
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import fitz  # PyMuPDF
 from loguru import logger
 from utils.logging_config import configure_logging
+from utils.pdf_workers import get_document_key, render_page
 
 # Configure logger
 logger = configure_logging()
 
+# Pages are rendered and encoded in parallel; each worker process opens its own
+# copy of the input, so the count is capped
+COMPRESS_WORKERS = min(os.cpu_count() or 1, 4)
 
-def compress_pdf(input_path, output_path, dpi=150, quality=60, grayscale=False):
+
+def create_render_pool(max_workers=COMPRESS_WORKERS):
+    """
+    Start the worker processes that render pages for compress_pdf.
+
+    The pool can be passed to several compress_pdf calls, so trying different
+    settings doesn't spawn new workers each time. PyMuPDF isn't fork-safe, so
+    the workers are spawned.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def compress_pdf(input_path, output_path, dpi=150, quality=60, grayscale=False, executor=None):
     """
     Compress a PDF by flattening each page to a JPEG image with specified quality.
 
@@ -35,6 +52,8 @@ def compress_pdf(input_path, output_path, dpi=150, quality=60, grayscale=False):
         dpi (int): Resolution for rendering PDF pages (higher = better quality but larger size)
         quality (int): JPEG compression quality (0-100, lower = smaller size but lower quality)
         grayscale (bool): Whether to convert to grayscale for additional compression
+        executor (ProcessPoolExecutor, optional): Pool from create_render_pool to render
+            the pages in; a pool is started for this call if not given
 
     Returns:
         tuple: (bool success, dict stats)
@@ -52,14 +71,20 @@ def compress_pdf(input_path, output_path, dpi=150, quality=60, grayscale=False):
         # Calculate zoom factor based on DPI (72 is the base DPI)
         zoom = dpi / 72
 
-        # Set up temp directory for page images
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_dir_path = Path(temp_dir)
+        logger.info(f"Processing {page_count} pages...")
 
-            logger.info(f"Processing {page_count} pages...")
+        # Render pages in worker processes, each opening its own copy of the input
+        if executor is None:
+            pool_context = create_render_pool(max(1, min(COMPRESS_WORKERS, page_count)))
+        else:
+            pool_context = nullcontext(executor)
 
-            # Process each page
-            for page_num, page in enumerate(pdf_document):
+        with pool_context as pool:
+            render = functools.partial(render_page, get_document_key(input_path), zoom, grayscale, quality)
+            rendered = pool.map(render, range(page_count), chunksize=4)
+
+            # Assemble the output in page order as results arrive
+            for page_num, (page, image_bytes) in enumerate(zip(pdf_document, rendered)):
                 # Use logger.debug for progress updates
                 if (page_num + 1) % 10 == 0 or page_num == 0 or page_num == page_count - 1:
                     logger.debug(f"Converting page {page_num + 1}/{page_count}")
@@ -67,27 +92,13 @@ def compress_pdf(input_path, output_path, dpi=150, quality=60, grayscale=False):
                 # Get page dimensions
                 rect = page.rect
 
-                # Convert page to image
-                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
-
-                # Convert to PIL Image
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-                # Optional grayscale conversion
-                if grayscale:
-                    img = img.convert("L")
-
-                # Save as JPEG with specified quality
-                img_path = temp_dir_path / f"page_{page_num + 1}.jpg"
-                img.save(img_path, "JPEG", quality=quality, optimize=True)
-
-                # Add image back to new PDF
+                # Add image back to new PDF straight from memory
                 new_page = output_pdf.new_page(width=rect.width, height=rect.height)
-                new_page.insert_image(rect, filename=str(img_path))
+                new_page.insert_image(rect, stream=image_bytes)
 
-            logger.info("Saving compressed PDF...")
-            output_pdf.save(output_path, garbage=4, deflate=True, clean=True)
-            output_pdf.close()
+        logger.info("Saving compressed PDF...")
+        output_pdf.save(output_path, garbage=4, deflate=True, clean=True)
+        output_pdf.close()
 
         # Get stats
         output_size = os.path.getsize(output_path)
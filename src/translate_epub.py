@@ -2,33 +2,114 @@ import os
 import shutil
 import yaml
 import zipfile
+import zlib
+import struct
 import re
 import hashlib
-import json
-from pathlib import Path
-from google import genai
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from pathlib import Path, PurePosixPath
 from utils.html_utils import clean_html_response
-from google.genai.types import (
-    GenerateContentConfig,
-    HarmBlockThreshold,
-    HarmCategory,
-    SafetySetting,
-    Part,
-)
+from utils.json_utils import json_loads, json_dumps
+from utils.config_parser import YamlLoader
 from utils.network_utils import generate_content_with_retry, get_default_generation_config
-import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 import argparse
 from loguru import logger
 from utils.logging_config import configure_logging
 
+# lxml is an optional, faster drop-in for parsing and writing toc.ncx;
+# fall back to the standard library without it
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
 # Configure logger
 logger = configure_logging()
 
+# Completed translations between progress writes, and the longest (in seconds)
+# a completed translation may stay unsaved once another one finishes
+PROGRESS_FLUSH_EVERY = 5
+PROGRESS_FLUSH_INTERVAL = 10
+
+# Part of the translation cache key; bump whenever the translation prompt changes
+TRANSLATION_PROMPT_VERSION = 1
+
+# Prompts for the translation requests; only the placeholders vary between calls
+HTML_PROMPT_TEMPLATE = """
+    Translate the HTML content provided in the multipart input from {source_language} to {target_language}.
+    
+    Book title: {book_title}
+    Chapter title: {chapter_title}
+    
+    STRICT RESPONSE FORMAT REQUIREMENTS:
+    - Your response must begin directly with <!DOCTYPE html> or <html> tag
+    - Return only raw HTML text, not formatted as JSON or markdown
+    - Do not include any explanations or commentary before or after the HTML
+    - Do not wrap the HTML in code blocks or quotes
+    
+    TRANSLATION REQUIREMENTS:
+    1. Preserve all HTML tags, attributes, and structure exactly as they are
+    2. Only translate the text content inside tags, not the tags themselves
+    3. Preserve all class names, IDs, and other attributes
+    4. Keep all image references and links intact
+    5. Maintain the same formatting and structure 
+    6. Translate all visible text, including image alt attributes, but don't change any code
+    7. Make sure the translation is accurate and natural-sounding in {target_language}
+    8. For names of people, places, or titles that have standard translations in {target_language},
+       use those standard translations
+    """
+
+CONTINUATION_PROMPT = """
+    
+    IMPORTANT: This is a CONTINUATION request. I previously received a partial HTML response that was cut off.
+    I'm providing that partial HTML and you need to continue from where it left off.
+    DO NOT restart the translation from the beginning.
+    DO NOT repeat the content I'm providing.
+    ONLY provide the remaining part of the HTML that completes the document.
+    """
+
+HTML_PROMPT_FOOTER_TEMPLATE = """
+    
+    {context}Return only the translated HTML as raw text, without any JSON formatting, markdown code blocks, or other commentary.
+    The response should start directly with the HTML content.
+    """
+
+TITLE_PROMPT_TEMPLATE = """
+    Translate the following book title from {source_language} to {target_language}.
+    Only return the translated title without any explanations or additional text.
+    
+    Book title: {book_title}
+    """
+
+TOC_PROMPT_TEMPLATE = """
+        Translate the following chapter titles from {source_language} to {target_language}.
+        Return only the translated titles, one per line, numbered as in the original list.
+        
+        {titles_str}
+        """
+
+# Strips the "N. " numbering the model keeps on translated TOC titles
+TOC_NUMBER_RE = re.compile(r"^\d+\.\s*")
+
+# File extensions of the additional HTML documents that get translated
+HTML_EXTENSIONS = (".html", ".htm")
+
+# Files rewritten in the translated directory; they are copied, everything else is
+# hardlinked. XHTML chapters referenced from toc.ncx are translated too.
+REWRITTEN_EXTENSIONS = HTML_EXTENSIONS + (".xhtml", ".opf", ".ncx")
+
+# Number of files deflated concurrently when building the final EPUB
+ZIP_COMPRESS_WORKERS = os.cpu_count() or 1
+
 
 def load_config():
     """Load configuration from config.yaml file."""
     with open("config.yaml", "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=YamlLoader)
     return config
 
 
@@ -43,70 +124,125 @@ def ensure_directory(directory_path):
     Path(directory_path).mkdir(parents=True, exist_ok=True)
 
 
-def extract_epub(epub_path, extract_dir):
-    """Extract EPUB contents to a directory."""
+def mirror_directory(src_dir, dst_dir):
+    """
+    Mirror src_dir into dst_dir, hardlinking files that are never rewritten.
+    
+    Files with REWRITTEN_EXTENSIONS are real copies, since writing to a
+    hardlink would also change the original. Everything else falls back to
+    a copy when hardlinks aren't possible (e.g. across filesystems).
+    """
+    stack = [(os.fspath(src_dir), os.fspath(dst_dir))]
+    while stack:
+        src, dst = stack.pop()
+        os.makedirs(dst, exist_ok=True)
+        with os.scandir(src) as it:
+            for entry in it:
+                target = os.path.join(dst, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, target))
+                    continue
+                if not entry.name.lower().endswith(REWRITTEN_EXTENSIONS):
+                    try:
+                        os.link(entry.path, target)
+                        continue
+                    except OSError:
+                        pass
+                shutil.copy2(entry.path, target)
+
+
+def extract_epub(epub_path, extract_dir, rewritten_only=False):
+    """Extract EPUB contents to a directory, or only the files translation rewrites."""
     with zipfile.ZipFile(epub_path, "r") as zip_ref:
-        zip_ref.extractall(extract_dir)
+        members = None
+        if rewritten_only:
+            members = [
+                name for name in zip_ref.namelist()
+                if name.lower().endswith(REWRITTEN_EXTENSIONS)
+            ]
+        zip_ref.extractall(extract_dir, members)
     logger.info(f"Extracted EPUB to {extract_dir}")
 
 
-def parse_toc_ncx(ncx_path):
-    """Parse the toc.ncx file to get chapter structure."""
-    tree = ET.parse(ncx_path)
-    root = tree.getroot()
-
-    # Extract namespace from root tag if it exists
-    namespace = ""
-    if "}" in root.tag:
-        namespace = root.tag.split("}")[0].strip("{")
+def get_ncx_namespace(tag):
+    """Return the "{uri}" namespace prefix of an element tag, or "" if it has none."""
+    return tag[:tag.index("}") + 1] if tag.startswith("{") else ""
 
-    # Define namespace dictionary for finding elements
-    ns = {"ncx": namespace} if namespace else {}
 
+def parse_toc_ncx(ncx_path):
+    """Parse the toc.ncx file to get chapter structure."""
     chapters = []
+    open_nav_points = []
+    nav_point_tag = None
+
+    # navPoints get their slot when they start, so chapters stay in document
+    # order, and are filled in when they end and their children are parsed
+    for event, elem in ET.iterparse(os.fspath(ncx_path), events=("start", "end")):
+        if nav_point_tag is None:
+            # The root element carries the NCX namespace, if any
+            ns = get_ncx_namespace(elem.tag)
+            nav_point_tag = f"{ns}navPoint"
+            nav_label_path = f".//{ns}navLabel"
+            text_tag = f"{ns}text"
+            content_tag = f"{ns}content"
+            content_path = f".//{ns}content"
+
+        if elem.tag != nav_point_tag:
+            continue
 
-    # Find all navPoint elements (chapters) at any level
-    nav_points_xpath = ".//ncx:navPoint" if ns else ".//navPoint"
-    for nav_point in root.findall(nav_points_xpath, ns):
-        # Get chapter title
-        if ns:
-            nav_label = nav_point.find(".//ncx:navLabel", ns)
-            title_elem = (
-                nav_label.find("ncx:text", ns) if nav_label is not None else None
-            )
-        else:
-            nav_label = nav_point.find(".//navLabel")
-            title_elem = nav_label.find("text") if nav_label is not None else None
+        if event == "start":
+            open_nav_points.append(len(chapters))
+            chapters.append(None)
+            continue
 
+        # Get chapter title
+        nav_label = elem.find(nav_label_path)
+        title_elem = nav_label.find(text_tag) if nav_label is not None else None
         title = title_elem.text if title_elem is not None else "Unknown Title"
 
         # Get chapter source file
-        if ns:
-            content_elem = nav_point.find("./ncx:content", ns)
-            if content_elem is None:
-                content_elem = nav_point.find(".//ncx:content", ns)
-        else:
-            content_elem = nav_point.find("./content")
-            if content_elem is None:
-                content_elem = nav_point.find(".//content")
+        content_elem = elem.find(content_tag)
+        if content_elem is None:
+            content_elem = elem.find(content_path)
 
+        index = open_nav_points.pop()
         if content_elem is not None:
-            src = content_elem.get("src")
-            chapters.append({"title": title, "src": src})
+            chapters[index] = {"title": title, "src": content_elem.get("src")}
 
-    return chapters
+        # Nested navPoints have been read, so drop their subtrees
+        elem.clear()
 
+    return [chapter for chapter in chapters if chapter is not None]
 
-def find_all_html_files(epub_extract_dir):
-    """Find all HTML files in the EPUB directory."""
-    all_html_files = []
-    for path in Path(epub_extract_dir).rglob("*.htm*"):  # Match both .html and .htm
-        if path.is_file():
-            # Get the relative path from the extract dir
-            rel_path = path.relative_to(epub_extract_dir).as_posix()
-            all_html_files.append(str(rel_path))
 
-    return all_html_files
+def iter_relative_files(root):
+    """Yield (name, relative POSIX path) for every file under root, using a single scandir walk."""
+    stack = [(os.fspath(root), "")]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, prefix + entry.name + "/"))
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.name, prefix + entry.name
+
+
+def build_file_index(root):
+    """Map each file name under root to the relative path of its first occurrence."""
+    file_index = {}
+    for name, rel_path in iter_relative_files(root):
+        file_index.setdefault(name, rel_path)
+    return file_index
+
+
+def find_all_html_files(epub_extract_dir):
+    """Find all HTML files in the EPUB directory, as POSIX paths relative to it."""
+    return [
+        rel_path
+        for name, rel_path in iter_relative_files(epub_extract_dir)
+        if name.lower().endswith(HTML_EXTENSIONS)
+    ]
 
 
 def translate_html_content(
@@ -133,7 +269,7 @@ def translate_html_content(
         client: The Gemini API client
         config: The configuration dictionary
         previous_content: Previous chapter content for context (optional)
-        partial_html: Partial HTML from a previous attempt (optional)
+        partial_html: Partial HTML chunks from previous attempts (optional)
         continuation_attempts: Number of continuation attempts made so far (optional)
         
     Returns:
@@ -159,48 +295,21 @@ def translate_html_content(
         context = f"Previous chapter content (for context only, do not translate this again):\n{previous_content[:previous_content_limit]}\n\n"
 
     # Create instruction prompt
-    prompt = f"""
-    Translate the HTML content provided in the multipart input from {source_language} to {target_language}.
-    
-    Book title: {book_title}
-    Chapter title: {chapter_title}
-    
-    STRICT RESPONSE FORMAT REQUIREMENTS:
-    - Your response must begin directly with <!DOCTYPE html> or <html> tag
-    - Return only raw HTML text, not formatted as JSON or markdown
-    - Do not include any explanations or commentary before or after the HTML
-    - Do not wrap the HTML in code blocks or quotes
-    
-    TRANSLATION REQUIREMENTS:
-    1. Preserve all HTML tags, attributes, and structure exactly as they are
-    2. Only translate the text content inside tags, not the tags themselves
-    3. Preserve all class names, IDs, and other attributes
-    4. Keep all image references and links intact
-    5. Maintain the same formatting and structure 
-    6. Translate all visible text, including image alt attributes, but don't change any code
-    7. Make sure the translation is accurate and natural-sounding in {target_language}
-    8. For names of people, places, or titles that have standard translations in {target_language},
-       use those standard translations
-    """
+    prompt = HTML_PROMPT_TEMPLATE.format(
+        source_language=source_language,
+        target_language=target_language,
+        book_title=book_title,
+        chapter_title=chapter_title,
+    )
     
     # Add continuation instructions if this is a continuation attempt
     if partial_html:
-        prompt += f"""
+        prompt += CONTINUATION_PROMPT
     
-    IMPORTANT: This is a CONTINUATION request. I previously received a partial HTML response that was cut off.
-    I'm providing that partial HTML and you need to continue from where it left off.
-    DO NOT restart the translation from the beginning.
-    DO NOT repeat the content I'm providing.
-    ONLY provide the remaining part of the HTML that completes the document.
-    """
-    
-    prompt += f"""
-    
-    {context}Return only the translated HTML as raw text, without any JSON formatting, markdown code blocks, or other commentary.
-    The response should start directly with the HTML content.
-    """
+    prompt += HTML_PROMPT_FOOTER_TEMPLATE.format(context=context)
 
     # Create multipart input with instruction and HTML content
+    from google.genai.types import Part
     parts = [
         prompt,
         Part.from_text(text=html_content)
@@ -213,20 +322,17 @@ def translate_html_content(
     num_retries = config.get("num_retries", 3)
     max_backoff = config.get("max_backoff_seconds", 30)
     
-    # Get generation config with slightly higher temperature for translation
-    generation_config = get_default_generation_config(temperature=0.2)
-    generation_config.response_mime_type = "application/xml"
-    
     # Generate content with retry using multipart input
     response = generate_content_with_retry(
         client=client,
         model=model,
         contents=parts,
-        config=generation_config,
+        config=get_default_generation_config(temperature=0.2, response_mime_type="application/xml"),
         max_retries=num_retries,
         max_backoff=max_backoff,
         operation_name=f"HTML translation for {chapter_title}" + (f" (continuation {continuation_attempts})" if partial_html else ""),
-        use_streaming=True
+        use_streaming=True,
+        stop_marker="</html>",
     )
     
     # Clean and return the translated HTML
@@ -250,7 +356,7 @@ def translate_html_content(
             client=client,
             config=config,
             previous_content=previous_content,
-            partial_html=result.get("content"),  # Pass the partial HTML
+            partial_html=result.get("chunks"),  # Pass the partial HTML chunks
             continuation_attempts=continuation_attempts + 1
         )
     
@@ -260,14 +366,203 @@ def translate_html_content(
     return result
 
 
-def translate_book_title(book_title, source_language, target_language, client, config):
-    """Translate the book title using Gemini API."""
-    prompt = f"""
-    Translate the following book title from {source_language} to {target_language}.
-    Only return the translated title without any explanations or additional text.
+def get_translation_cache_key(html_content, source_language, target_language, config):
+    """Return the response cache key for translating html_content with the current model and prompt."""
+    model = config.get("model", "gemini-2.5-pro-preview-03-25")
+    prefix = f"{model}|{source_language}|{target_language}|{TRANSLATION_PROMPT_VERSION}|"
+    return hashlib.sha256(prefix.encode("utf-8") + html_content.encode("utf-8")).hexdigest()
+
+
+def translate_html_content_cached(
+    cache_dir,
+    html_content,
+    chapter_title,
+    book_title,
+    source_language,
+    target_language,
+    client,
+    config,
+    previous_content=None,
+):
+    """
+    Translate HTML content, reusing a cached response for identical input.
     
-    Book title: {book_title}
+    Responses are only cached when no previous content is sent as context,
+    since the context changes the prompt.
+    
+    Args:
+        cache_dir: Directory holding cached translations
+        html_content: The HTML content to translate
+        chapter_title: The title of the chapter
+        book_title: The title of the book
+        source_language: The source language
+        target_language: The target language
+        client: The Gemini API client
+        config: The configuration dictionary
+        previous_content: Previous chapter content for context (optional)
+        
+    Returns:
+        str: The translated HTML content
     """
+    use_cache = not (previous_content and config.get("previous_content_limit", 0) > 0)
+    if use_cache:
+        key = get_translation_cache_key(html_content, source_language, target_language, config)
+        cache_path = Path(cache_dir) / f"{key}.html"
+        try:
+            cached_html = cache_path.read_text(encoding="utf-8")
+            logger.info(f"Using cached translation for {chapter_title}")
+            return cached_html
+        except FileNotFoundError:
+            pass
+
+    translated_html = translate_html_content(
+        html_content,
+        chapter_title,
+        book_title,
+        source_language,
+        target_language,
+        client,
+        config,
+        previous_content,
+    )
+
+    if use_cache:
+        # Written atomically, since worker threads may translate identical files
+        temp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_text(translated_html, encoding="utf-8")
+        os.replace(temp_path, cache_path)
+
+    return translated_html
+
+
+def translate_html_files(
+    work_items,
+    previous_content,
+    translated_book_title,
+    source_language,
+    target_language,
+    client,
+    config,
+    cache_dir,
+    on_translated,
+):
+    """
+    Translate HTML files, several at a time if max_concurrency allows.
+    
+    Each file is read from the extracted EPUB rather than from its output path,
+    so a file translated before an interrupted run saved its progress is
+    translated again from the original rather than from its translation.
+    
+    Args:
+        work_items: List of (index, source_path, path, title, description) tuples for the
+            files to translate; the translation of source_path is written to path, and
+            description is logged when it starts
+        previous_content: Context from the previously translated file (optional)
+        translated_book_title: The translated title of the book
+        source_language: The source language
+        target_language: The target language
+        client: The Gemini API client, shared by all worker threads
+        config: The configuration dictionary
+        cache_dir: Directory holding cached translations
+        on_translated: Called with the index of each file once it has been written
+        
+    Returns:
+        str: Context for the next translation, or None
+    """
+    previous_content_limit = config.get("previous_content_limit", 0)
+    # Context needs the files translated in order, so unless concurrency was
+    # asked for explicitly it stays sequential when context is enabled
+    max_concurrency = config.get("max_concurrency", 1 if previous_content_limit > 0 else 4)
+    if max_concurrency > 1 and previous_content_limit > 0 and work_items:
+        logger.warning(
+            f"previous_content_limit is ignored because max_concurrency is {max_concurrency}; "
+            "set max_concurrency to 1 to translate with previous content as context"
+        )
+
+    def translate(source_path, title, description, context):
+        logger.info(description)
+        html_content = Path(source_path).read_text(encoding="utf-8")
+        return translate_html_content_cached(
+            cache_dir,
+            html_content,
+            title,
+            translated_book_title,
+            source_language,
+            target_language,
+            client,
+            config,
+            context,
+        )
+
+    if max_concurrency <= 1:
+        for index, source_path, path, title, description in work_items:
+            translated_html = translate(source_path, title, description, previous_content)
+            Path(path).write_text(translated_html, encoding="utf-8")
+
+            # Store for context in next translation based on config limit. The
+            # slice returns translated_html itself when it is within the limit,
+            # and whitespace-only context is dropped instead of being sent.
+            if previous_content_limit > 0:
+                previous_content = translated_html[:previous_content_limit].rstrip() or None
+            else:
+                previous_content = None
+
+            on_translated(index)
+        return previous_content
+
+    # Files finish out of order when translated concurrently, so no previous
+    # content is passed as context. Results are written and reported from this
+    # thread only, so progress updates need no locking.
+    first_error = None
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(translate, source_path, title, description, None): (index, path, title)
+            for index, source_path, path, title, description in work_items
+        }
+
+        try:
+            for future in as_completed(futures):
+                index, path, title = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    translated_html = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to translate {title}: {e}")
+                    if first_error is None:
+                        first_error = e
+                        # Don't start the files still queued; those already
+                        # running finish and are written below
+                        executor.shutdown(wait=False, cancel_futures=True)
+                    continue
+
+                Path(path).write_text(translated_html, encoding="utf-8")
+                on_translated(index)
+        except BaseException:
+            # Interrupted (e.g. Ctrl-C): drop the queued files instead of
+            # making their Gemini calls while the pool shuts down
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if first_error is not None:
+        raise first_error
+    return None
+
+
+def advance_processed_index(items, last_index):
+    """Return the last index of the contiguous run of translated items after last_index."""
+    while last_index + 1 < len(items) and items[last_index + 1].get("translated", False):
+        last_index += 1
+    return last_index
+
+
+def translate_book_title(book_title, source_language, target_language, client, config):
+    """Translate the book title using Gemini API."""
+    prompt = TITLE_PROMPT_TEMPLATE.format(
+        source_language=source_language,
+        target_language=target_language,
+        book_title=book_title,
+    )
 
     # Get model from config with fallback
     model = config.get("model", "gemini-2.5-pro-preview-03-25")
@@ -276,15 +571,12 @@ def translate_book_title(book_title, source_language, target_language, client, c
     num_retries = config.get("num_retries", 3)
     max_backoff = config.get("max_backoff_seconds", 30)
     
-    # Get generation config
-    generation_config = get_default_generation_config(temperature=0.1)
-    
     # Generate content with retry
     response = generate_content_with_retry(
         client=client,
         model=model,
         contents=prompt,
-        config=generation_config,
+        config=get_default_generation_config(temperature=0.1),
         max_retries=num_retries,
         max_backoff=max_backoff,
         operation_name="Book title translation",
@@ -306,12 +598,11 @@ def translate_toc_entries(chapters, source_language, target_language, client, co
         titles = [chapter["title"] for chapter in batch]
         titles_str = "\n".join([f"{j + 1}. {title}" for j, title in enumerate(titles)])
 
-        prompt = f"""
-        Translate the following chapter titles from {source_language} to {target_language}.
-        Return only the translated titles, one per line, numbered as in the original list.
-        
-        {titles_str}
-        """
+        prompt = TOC_PROMPT_TEMPLATE.format(
+            source_language=source_language,
+            target_language=target_language,
+            titles_str=titles_str,
+        )
 
         # Get model from config with fallback
         model = config.get("model", "gemini-2.5-pro-preview-03-25")
@@ -320,15 +611,12 @@ def translate_toc_entries(chapters, source_language, target_language, client, co
         num_retries = config.get("num_retries", 3)
         max_backoff = config.get("max_backoff_seconds", 30)
         
-        # Get generation config
-        generation_config = get_default_generation_config(temperature=0.1)
-        
         # Generate content with retry
         response = generate_content_with_retry(
             client=client,
             model=model,
             contents=prompt,
-            config=generation_config,
+            config=get_default_generation_config(temperature=0.1),
             max_retries=num_retries,
             max_backoff=max_backoff,
             operation_name=f"TOC entries translation (batch {i // batch_size + 1})",
@@ -337,7 +625,7 @@ def translate_toc_entries(chapters, source_language, target_language, client, co
 
         translated_titles = response.text.strip().split("\n")
         cleaned_titles = [
-            re.sub(r"^\d+\.\s*", "", title).strip() for title in translated_titles
+            TOC_NUMBER_RE.sub("", title).strip() for title in translated_titles
         ]
 
         for j, chapter in enumerate(batch):
@@ -364,62 +652,148 @@ def translate_toc_entries(chapters, source_language, target_language, client, co
 
 def update_toc_ncx(toc_path, translated_chapters):
     """Update the toc.ncx file with translated chapter titles."""
-    tree = ET.parse(toc_path)
+    tree = ET.parse(os.fspath(toc_path))
     root = tree.getroot()
 
-    # Extract namespace from root tag if it exists
-    namespace = ""
-    if "}" in root.tag:
-        namespace = root.tag.split("}")[0] + "}"
+    # Qualified tag names, so matching is a plain tag comparison
+    ns = get_ncx_namespace(root.tag)
+    content_tag = f"{ns}content"
+    text_path = f".//{ns}text"
 
-    # Define namespace dictionary for finding elements
-    ns = {"ncx": namespace.strip("{}")} if namespace else {}
+    # Chapters are matched by file name to account for variations in path
+    # representation; the first chapter with a given name wins
+    chapters_by_name = {}
+    for chapter in translated_chapters:
+        chapters_by_name.setdefault(PurePosixPath(chapter["src"]).name, chapter)
 
     # Update each navPoint with the translated title
-    nav_points_xpath = ".//ncx:navPoint" if ns else ".//navPoint"
-    for nav_point in root.findall(nav_points_xpath, ns):
+    for nav_point in root.iter(f"{ns}navPoint"):
         # Get content element to find src
-        content_elem_xpath = "./ncx:content" if ns else "./content"
-        content_elem = nav_point.find(content_elem_xpath, ns)
+        content_elem = nav_point.find(content_tag)
 
         if content_elem is not None:
             src = content_elem.get("src")
 
             # Find matching chapter
-            for chapter in translated_chapters:
-                # Account for variations in path representation
-                if Path(chapter["src"]).name == Path(src).name:
-                    # Update the title
-                    text_elem_xpath = ".//ncx:text" if ns else ".//text"
-                    title_elem = nav_point.find(text_elem_xpath, ns)
-                    if title_elem is not None:
-                        title_elem.text = chapter["title"]
-                    break
+            chapter = chapters_by_name.get(PurePosixPath(src).name)
+            if chapter is not None:
+                # Update the title
+                title_elem = nav_point.find(text_path)
+                if title_elem is not None:
+                    title_elem.text = chapter["title"]
 
     # Write updated toc.ncx
-    tree.write(toc_path, encoding="utf-8", xml_declaration=True)
+    tree.write(os.fspath(toc_path), encoding="utf-8", xml_declaration=True)
 
 
 def calculate_file_hash(file_path):
-    """Calculate MD5 hash of a file for comparison."""
-    hasher = hashlib.md5()
+    """Calculate the BLAKE2b hash of a file for comparison, without reading it into memory at once."""
     with open(file_path, "rb") as file:
-        buf = file.read()
-        hasher.update(buf)
-    return hasher.hexdigest()
+        return hashlib.file_digest(file, "blake2b").hexdigest()
+
+
+def compress_zip_entry(file_path, arcname):
+    """Deflate a file for the archive, returning its ZipInfo and the raw compressed bytes."""
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    data = Path(file_path).read_bytes()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    return zinfo, compressed
+
+
+def replace_opf_title(content_opf_content, title):
+    """Replace the text of the first <dc:title> element, escaping the new title for XML."""
+    start = content_opf_content.find("<dc:title")
+    if start < 0:
+        return content_opf_content
+    text_start = content_opf_content.find(">", start) + 1
+    text_end = content_opf_content.find("</dc:title>", text_start)
+    if text_start == 0 or text_end < 0:
+        return content_opf_content
+    return content_opf_content[:text_start] + escape(title) + content_opf_content[text_end:]
+
+
+def write_precompressed_entry(zipf, zinfo, compressed):
+    """
+    Append an entry whose data is already compressed.
+    
+    zipfile has no public API for raw entries, so this does what
+    ZipFile.writestr does internally, minus the compression step.
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with zipf._lock:
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.write(compressed)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+
+def copy_raw_zip_entry(source_zip, zipf, info):
+    """Copy an entry's compressed data from source_zip into zipf without decompressing it."""
+    # The local header's name and extra field lengths can differ from the
+    # central directory's, so they are read from the header itself
+    fp = source_zip.fp
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    zinfo.compress_size = info.compress_size
+    write_precompressed_entry(zipf, zinfo, fp.read(info.compress_size))
+
+
+class ProgressTracker:
+    """Keep translation progress in memory and write it every few updates or seconds."""
+
+    def __init__(self, progress_file, progress):
+        self.progress_file = progress_file
+        self.progress = progress
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def mark_dirty(self):
+        """Record an in-place update, writing the file if enough have accumulated."""
+        self.pending += 1
+        if (
+            self.pending >= PROGRESS_FLUSH_EVERY
+            or time.monotonic() - self.last_flush > PROGRESS_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the progress file if anything changed since the last flush."""
+        if self.pending:
+            save_translation_progress(self.progress_file, self.progress)
+            self.pending = 0
+        self.last_flush = time.monotonic()
 
 
 def save_translation_progress(progress_file, progress_data):
-    """Save translation progress to a JSON file."""
-    with open(progress_file, "w", encoding="utf-8") as f:
-        json.dump(progress_data, f, indent=2)
+    """Save translation progress to a compact JSON file."""
+    # Write to a temporary file and rename it, so an interrupted save never
+    # leaves a truncated progress file behind
+    temp_file = Path(progress_file).with_suffix(".json.tmp")
+    temp_file.write_bytes(json_dumps(progress_data))
+    os.replace(temp_file, progress_file)
 
 
 def load_translation_progress(progress_file):
     """Load translation progress from a JSON file."""
     if Path(progress_file).exists():
-        with open(progress_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return json_loads(Path(progress_file).read_bytes())
     return {
         "book_title_translated": False,
         "toc_translated": False,
@@ -450,13 +824,19 @@ def translate_epub(input_epub_path, source_language, target_language, config):
         raise ValueError("Google API key not found in config.yaml")
     client = setup_genai_api(api_key)
 
+    # In in-place zip mode only the files that get rewritten are extracted;
+    # all other entries are copied straight from the input EPUB at the end
+    in_place_zip = config.get("in_place_zip", False)
+
     # Setup directories
     output_dir = Path("output") / Path(original_book_title)
     epub_extract_dir = output_dir / "extract"
     epub_translated_dir = output_dir / "translated"
     progress_file = output_dir / "translation_progress.json"
+    translation_cache_dir = output_dir / "llm_cache"
 
     ensure_directory(output_dir)
+    ensure_directory(translation_cache_dir)
 
     # Check if we're resuming a previous translation
     resuming = epub_translated_dir.exists()
@@ -465,13 +845,22 @@ def translate_epub(input_epub_path, source_language, target_language, config):
     if resuming:
         logger.info("Found existing translation. Attempting to resume...")
         progress = load_translation_progress(progress_file)
+        # The extracted tree only holds every file if the run started without
+        # in-place zip mode, so the mode is taken from the saved progress
+        saved_in_place_zip = progress.get("in_place_zip", False)
+        if saved_in_place_zip != in_place_zip:
+            logger.warning(
+                f"Resuming with in_place_zip={saved_in_place_zip} as in the original run, "
+                f"ignoring in_place_zip={in_place_zip}"
+            )
+            in_place_zip = saved_in_place_zip
     else:
         # Start fresh
         ensure_directory(epub_extract_dir)
         ensure_directory(epub_translated_dir)
 
         # Extract the EPUB
-        extract_epub(input_epub_path, epub_extract_dir)
+        extract_epub(input_epub_path, epub_extract_dir, rewritten_only=in_place_zip)
 
         # Initialize progress tracking
         progress = {
@@ -483,16 +872,18 @@ def translate_epub(input_epub_path, source_language, target_language, config):
             "translated_book_title": "",
             "last_processed_chapter_index": -1,
             "last_processed_html_index": -1,
+            "in_place_zip": in_place_zip,
         }
 
-    # Find toc.ncx
-    toc_ncx_path = None
-    for path in Path(epub_extract_dir).rglob("toc.ncx"):
-        toc_ncx_path = path
-        break
+    # Index the extracted files by name once; the translated directory is a copy
+    # of it, so the same relative paths are used to look up toc.ncx, content.opf
+    # and every chapter file
+    file_index = build_file_index(epub_extract_dir)
 
-    if not toc_ncx_path:
+    # Find toc.ncx
+    if "toc.ncx" not in file_index:
         raise FileNotFoundError("toc.ncx not found in the EPUB file.")
+    toc_ncx_path = Path(epub_extract_dir) / file_index["toc.ncx"]
 
     # Parse toc.ncx to get chapter structure
     chapters = parse_toc_ncx(toc_ncx_path)
@@ -572,7 +963,7 @@ def translate_epub(input_epub_path, source_language, target_language, config):
 
     # Copy all files to the translated directory first (if not already done)
     if not resuming:
-        shutil.copytree(epub_extract_dir, epub_translated_dir, dirs_exist_ok=True)
+        mirror_directory(epub_extract_dir, epub_translated_dir)
 
     # Update toc.ncx with translated titles (if not already done)
     translated_toc_path = Path(epub_translated_dir) / toc_ncx_path.relative_to(
@@ -583,18 +974,13 @@ def translate_epub(input_epub_path, source_language, target_language, config):
 
     # Update content.opf to update book title (if not already done)
     if not progress["content_opf_updated"]:
-        content_opf_paths = list(Path(epub_translated_dir).rglob("content.opf"))
-        if content_opf_paths:
-            content_opf_path = content_opf_paths[0]
+        if "content.opf" in file_index:
+            content_opf_path = Path(epub_translated_dir) / file_index["content.opf"]
             with open(content_opf_path, "r", encoding="utf-8") as f:
                 content_opf_content = f.read()
 
             # Update title in content.opf
-            content_opf_content = re.sub(
-                r"<dc:title>.*?</dc:title>",
-                f"<dc:title>{translated_book_title}</dc:title>",
-                content_opf_content,
-            )
+            content_opf_content = replace_opf_title(content_opf_content, translated_book_title)
 
             with open(content_opf_path, "w", encoding="utf-8") as f:
                 f.write(content_opf_content)
@@ -603,8 +989,10 @@ def translate_epub(input_epub_path, source_language, target_language, config):
             save_translation_progress(progress_file, progress)
 
     # Translate chapters that haven't been translated yet
+    tracker = ProgressTracker(progress_file, progress)
     previous_content = None
     start_index = progress["last_processed_chapter_index"] + 1
+    chapter_items = []
 
     for i, chapter in enumerate(translated_chapters[start_index:], start=start_index):
         if progress["translated_chapters"][i].get("translated", False):
@@ -613,53 +1001,45 @@ def translate_epub(input_epub_path, source_language, target_language, config):
             )
             continue
 
-        chapter_path = None
-        chapter_src = chapter["src"]
-
         # Find the full path to the chapter file
-        for path in Path(epub_translated_dir).rglob(Path(chapter_src).name):
-            chapter_path = path
-            break
-
-        if chapter_path:
-            logger.info(
-                f"Translating chapter {i + 1}/{len(translated_chapters)}: {chapter['original_title']} → {chapter['title']}"
-            )
-
-            # Read the HTML content
-            with open(chapter_path, "r", encoding="utf-8") as f:
-                html_content = f.read()
+        chapter_rel_path = file_index.get(Path(chapter["src"]).name)
 
-            # Translate the HTML content
-            translated_html = translate_html_content(
-                html_content,
+        if chapter_rel_path:
+            chapter_items.append((
+                i,
+                Path(epub_extract_dir) / chapter_rel_path,
+                Path(epub_translated_dir) / chapter_rel_path,
                 chapter["title"],
-                translated_book_title,
-                source_language,
-                target_language,
-                client,
-                config,
-                previous_content,
-            )
-
-            # Save the translated HTML
-            with open(chapter_path, "w", encoding="utf-8") as f:
-                f.write(translated_html)
-
-            # Store for context in next translation based on config limit
-            previous_content_limit = config.get("previous_content_limit", 0)
-            if previous_content_limit > 0:
-                previous_content = translated_html[:previous_content_limit]
-            else:
-                previous_content = None
-
-            # Update progress
-            progress["translated_chapters"][i]["translated"] = True
-            progress["last_processed_chapter_index"] = i
-            save_translation_progress(progress_file, progress)
+                f"Translating chapter {i + 1}/{len(translated_chapters)}: {chapter['original_title']} → {chapter['title']}",
+            ))
+
+    def mark_chapter_translated(i):
+        # Chapters can finish out of order, so the index only advances over the
+        # contiguous run of translated chapters
+        progress["translated_chapters"][i]["translated"] = True
+        progress["last_processed_chapter_index"] = advance_processed_index(
+            progress["translated_chapters"], progress["last_processed_chapter_index"]
+        )
+        tracker.mark_dirty()
+
+    try:
+        previous_content = translate_html_files(
+            chapter_items,
+            previous_content,
+            translated_book_title,
+            source_language,
+            target_language,
+            client,
+            config,
+            translation_cache_dir,
+            mark_chapter_translated,
+        )
+    finally:
+        tracker.flush()
 
     # Now translate additional HTML files
     start_html_index = progress["last_processed_html_index"] + 1
+    html_items = []
 
     for i, html_file_info in enumerate(
         progress["translated_html_files"][start_html_index:], start=start_html_index
@@ -670,44 +1050,38 @@ def translate_epub(input_epub_path, source_language, target_language, config):
             )
             continue
 
-        html_path = Path(epub_translated_dir) / html_file_info["src"]
+        html_source_path = Path(epub_extract_dir) / html_file_info["src"]
 
-        if html_path.exists():
-            logger.info(
-                f"Translating additional HTML file {i + 1}/{len(progress['translated_html_files'])}: {html_file_info['src']}"
-            )
-
-            # Read the HTML content
-            with open(html_path, "r", encoding="utf-8") as f:
-                html_content = f.read()
-
-            # Translate the HTML content
-            translated_html = translate_html_content(
-                html_content,
+        if html_source_path.exists():
+            html_items.append((
+                i,
+                html_source_path,
+                Path(epub_translated_dir) / html_file_info["src"],
                 html_file_info["title"],
-                translated_book_title,
-                source_language,
-                target_language,
-                client,
-                config,
-                previous_content,
-            )
+                f"Translating additional HTML file {i + 1}/{len(progress['translated_html_files'])}: {html_file_info['src']}",
+            ))
 
-            # Save the translated HTML
-            with open(html_path, "w", encoding="utf-8") as f:
-                f.write(translated_html)
-
-            # Store for context in next translation based on config limit
-            previous_content_limit = config.get("previous_content_limit", 0)
-            if previous_content_limit > 0:
-                previous_content = translated_html[:previous_content_limit]
-            else:
-                previous_content = None
-
-            # Update progress
-            progress["translated_html_files"][i]["translated"] = True
-            progress["last_processed_html_index"] = i
-            save_translation_progress(progress_file, progress)
+    def mark_html_file_translated(i):
+        progress["translated_html_files"][i]["translated"] = True
+        progress["last_processed_html_index"] = advance_processed_index(
+            progress["translated_html_files"], progress["last_processed_html_index"]
+        )
+        tracker.mark_dirty()
+
+    try:
+        translate_html_files(
+            html_items,
+            previous_content,
+            translated_book_title,
+            source_language,
+            target_language,
+            client,
+            config,
+            translation_cache_dir,
+            mark_html_file_translated,
+        )
+    finally:
+        tracker.flush()
 
     # Create the final EPUB file
     output_epub_path = output_dir / f"{translated_book_title}.epub"
@@ -715,14 +1089,24 @@ def translate_epub(input_epub_path, source_language, target_language, config):
     # Create a temporary zip file
     temp_zip = output_dir / "temp.zip"
 
-    # Create the EPUB zip file
-    with zipfile.ZipFile(temp_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
+    # Create the EPUB zip file, reading unchanged entries from the input EPUB
+    if in_place_zip or Path(input_epub_path).exists():
+        source_context = zipfile.ZipFile(input_epub_path, "r")
+    else:
+        source_context = nullcontext()
+
+    with source_context as source_zip, zipfile.ZipFile(temp_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
+        source_infos = {info.filename: info for info in source_zip.infolist()} if source_zip else {}
+
         # First add the mimetype file (must be uncompressed)
         mimetype_path = Path(epub_translated_dir) / "mimetype"
         if mimetype_path.exists():
             zipf.write(mimetype_path, "mimetype", compress_type=zipfile.ZIP_STORED)
+        elif "mimetype" in source_infos:
+            zipf.writestr("mimetype", source_zip.read("mimetype"), compress_type=zipfile.ZIP_STORED)
 
-        # Add all other files
+        # Collect all other files
+        entries = []
         for folder_name, subfolders, filenames in os.walk(epub_translated_dir):
             folder_path = Path(folder_name)
             relative_path = folder_path.relative_to(epub_translated_dir)
@@ -734,8 +1118,38 @@ def translate_epub(input_epub_path, source_language, target_language, config):
             # Add all files in the current folder
             for filename in filenames:
                 file_path = folder_path / filename
-                arcname = Path(relative_path) / filename
-                zipf.write(file_path, arcname)
+                arcname = (relative_path / filename).as_posix()
+                entries.append((file_path, arcname))
+
+        # Files that are never rewritten are identical to the input EPUB's, so
+        # their compressed data is copied as-is. The rest are deflated on all
+        # cores (zlib releases the GIL) and written in walk order from this thread.
+        with ThreadPoolExecutor(max_workers=ZIP_COMPRESS_WORKERS) as executor:
+            pending = []
+            for file_path, arcname in entries:
+                info = source_infos.get(arcname)
+                if (
+                    info is not None
+                    and not arcname.lower().endswith(REWRITTEN_EXTENSIONS)
+                    and os.path.getsize(file_path) == info.file_size
+                ):
+                    pending.append(info)
+                else:
+                    pending.append(executor.submit(compress_zip_entry, file_path, arcname))
+
+            for item in pending:
+                if isinstance(item, zipfile.ZipInfo):
+                    copy_raw_zip_entry(source_zip, zipf, item)
+                else:
+                    write_precompressed_entry(zipf, *item.result())
+
+        # Copy the entries that were never extracted from the input EPUB
+        if in_place_zip:
+            written = set(zipf.namelist())
+            for info in source_zip.infolist():
+                if info.is_dir() or info.filename in written:
+                    continue
+                copy_raw_zip_entry(source_zip, zipf, info)
 
     # Rename the zip file to epub
     shutil.move(temp_zip, output_epub_path)
@@ -771,12 +1185,18 @@ def main():
         action="store_true",
         help="Resume previous translation if available",
     )
+    parser.add_argument(
+        "--in-place-zip",
+        action="store_true",
+        help="Only extract the files that get translated and copy the rest from the input EPUB "
+        "(a resumed translation keeps the setting of the run that started it)",
+    )
 
     args = parser.parse_args()
 
     # Load configuration
     with open(args.config, "r", encoding="utf-8") as file:
-        config = yaml.safe_load(file)
+        config = yaml.load(file, Loader=YamlLoader)
 
     # Get source and target languages from config or defaults
     source_lang = args.source_lang
@@ -789,6 +1209,7 @@ def main():
 
     # Add command line arguments to config
     config["input_epub_path"] = args.input
+    config["in_place_zip"] = args.in_place_zip
 
     # Translate the EPUB
     translate_epub(args.input, source_lang, target_lang, config)
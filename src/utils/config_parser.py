@@ -1,6 +1,12 @@
 import yaml
 from typing import Optional
 
+# Prefer the libyaml-backed C loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 
 def get_config_value(config_path: str, key: str) -> Optional[str]:
     """
@@ -15,7 +21,7 @@ def get_config_value(config_path: str, key: str) -> Optional[str]:
     """
     try:
         with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YamlLoader)
             
         return str(config.get(key, '')).strip()
     except Exception as e:
@@ -1,127 +1,157 @@
 import json
 import re
 from loguru import logger
+from utils.json_utils import json_loads
 
+# Patterns used on every cleaned response, compiled once at import
+# Matches opening fences with or without a language tag as well as closing fences
+FENCE_RE = re.compile(r"```[a-zA-Z]*\s*")
 
-def clean_html_response(html_content, previous_content=None, max_retries=3):
+# Opening tags that mark a partial document worth continuing; only whether
+# one starts matters, so the pattern never scans ahead for the closing ">"
+OPENING_TAG_RE = re.compile(r"<(?:html|body|div)\b", re.IGNORECASE)
+BLANK_LINES_RE = re.compile(r"\n{2,}")
+
+# Closing tags of the blocks extract_html_block looks for
+CLOSING_TAG_RE = re.compile(r"</(?:html|body|div)>", re.IGNORECASE)
+
+# Fallback blocks tried when there is no complete <html> document, in order
+FALLBACK_BLOCKS = (("<body", "</body>"), ("<div", "</div>"))
+
+
+def extract_html_block(html_content):
+    """
+    Extract the outermost HTML document, body or div block from a response.
+    
+    Uses plain find/rfind scans on a lowercased copy instead of DOTALL regex
+    searches, which backtrack across the whole response.
+    
+    Args:
+        html_content (str): The response text to search
+        
+    Returns:
+        str: The extracted block, or None if no complete block was found
+    """
+    lc = html_content.lower()
+    
+    # Try to match full HTML document first - support both HTML and XML declarations,
+    # starting from whichever of them comes first in the text
+    end = lc.rfind("</html>")
+    if end >= 0:
+        starts = [lc.find(opening) for opening in ("<?xml", "<!doctype", "<html")]
+        start = min((index for index in starts if index >= 0), default=-1)
+        if 0 <= start < end:
+            return html_content[start:end + len("</html>")]
+    
+    # Otherwise try the body content, then any HTML-like content between div tags
+    for opening, closing in FALLBACK_BLOCKS:
+        start = lc.find(opening)
+        end = lc.rfind(closing)
+        if 0 <= start < end:
+            return html_content[start:end + len(closing)]
+    
+    return None
+
+
+def has_complete_html(html_content):
+    """Return whether the content contains an <html> element followed by a closing </html>, in any case."""
+    lc = html_content.lower()
+    start = lc.find("<html")
+    return start != -1 and lc.rfind("</html>") > start
+
+
+def clean_html_response(html_content, previous_content=None):
     """
     Clean the HTML response from Gemini.
     
     Args:
         html_content (str): The HTML content to clean
-        previous_content (str, optional): Previous partial HTML content to continue from
-        max_retries (int, optional): Maximum number of retries for partial content
+        previous_content (str | list[str], optional): Previous partial HTML content to
+            continue from, either as one string or as the "chunks" of a partial result
         
     Returns:
-        str: The cleaned HTML content
+        str | dict: The cleaned HTML content, or for a partial document a dict with
+            "status" set to "partial" and the unjoined "chunks" received so far
+        
+    Raises:
+        ValueError: If the response contains no usable HTML
     """
     if html_content is None:
         return None
     
+    # Only the new response is unwrapped below; previous chunks were already
+    # cleaned when they were returned as partial
+    
+    # First try to parse as JSON in case response was JSON-encoded; only
+    # a JSON string or object can hold the HTML, so skip the parse otherwise
+    if html_content.lstrip()[:1] in ('"', "{"):
+        try:
+            parsed = json_loads(html_content)
+            if isinstance(parsed, str):
+                html_content = parsed
+            elif isinstance(parsed, dict) and "html" in parsed:
+                html_content = parsed["html"]
+        except json.JSONDecodeError:
+            pass  # Not JSON, proceed with normal cleaning
+        
+    # Clean up markdown code blocks
+    if "```" in html_content:
+        html_content = FENCE_RE.sub("", html_content)
+    
     # Check if the new content itself contains a complete HTML document
     # This handles the case where continuation generates a full HTML instead of just the missing part
+    chunks = [html_content]
     if previous_content:
         # Check for complete HTML in the new content
-        html_match_in_new = re.search(
-            r"(?:<\?xml.*?\?>)?(?:<\!DOCTYPE.*?>)?(?:<html.*?>).*?<\/html>", html_content, re.DOTALL
-        )
-        
-        if html_match_in_new:
+        if has_complete_html(html_content):
             logger.info("Detected complete HTML in continuation response, using it directly")
-            # Use only the new content since it's complete
-            # No need to combine with previous_content
+            # Use only the new content since it's complete, without ever
+            # joining it to the previous chunks
         else:
             # Continue with normal continuation by combining previous and new content
             logger.info("Continuing from previous partial HTML content")
-            html_content = previous_content + html_content
-    
-    retry_count = 0
-    while retry_count < max_retries:
-        try:
-            # First try to parse as JSON in case response was JSON-encoded
-            try:
-                parsed = json.loads(html_content)
-                if isinstance(parsed, str):
-                    html_content = parsed
-                elif isinstance(parsed, dict) and "html" in parsed:
-                    html_content = parsed["html"]
-            except json.JSONDecodeError:
-                pass  # Not JSON, proceed with normal cleaning
-                
-            # Clean up markdown code blocks
-            html_content = re.sub(r"```html\s*", "", html_content)
-            html_content = re.sub(r"```\s*$", "", html_content)
-            html_content = re.sub(r"```[a-zA-Z]*\s*", "", html_content)
-            
-            # Extract HTML content
-            # Try to match full HTML document first - support both HTML and XML declarations
-            html_match = re.search(
-                r"(?:<\?xml.*?\?>)?(?:<\!DOCTYPE.*?>)?(?:<html.*?>).*?<\/html>", html_content, re.DOTALL
-            )
-            
-            # If no match, try to match just the body content
-            if not html_match:
-                html_match = re.search(
-                    r"(?:<body.*?>).*?<\/body>", html_content, re.DOTALL
-                )
-                
-            # If still no match, try to match any HTML-like content between div tags
-            if not html_match:
-                html_match = re.search(
-                    r"<div.*?>.*?<\/div>", html_content, re.DOTALL
-                )
-                
-            if not html_match:
-                # Check if we have a partial HTML document (opening tags without closing tags)
-                # This indicates we need to get more content
-                has_opening_html = re.search(r"<html.*?>", html_content, re.DOTALL) is not None
-                has_opening_body = re.search(r"<body.*?>", html_content, re.DOTALL) is not None
-                has_opening_div = re.search(r"<div.*?>", html_content, re.DOTALL) is not None
-                
-                if has_opening_html or has_opening_body or has_opening_div:
-                    # We have a partial document, return it for continuation
-                    logger.warning("Detected partial HTML document, returning for continuation")
-                    return {
-                        "status": "partial",
-                        "content": html_content
-                    }
-                
-                # If we can't find valid HTML, log the raw response for debugging
-                logger.error("Failed to find valid HTML structure in response")
-                logger.debug("Response content structure:")
-                logger.debug("-" * 40)
-                # Remove extra newlines for better readability
-                html_content = re.sub(r"\n{2,}", "\n", html_content)
-                logger.debug(f"{html_content[:500]}\n ... \n{html_content[-500:]}")
-                logger.debug("-" * 40)
-                
-                if retry_count < max_retries - 1:
-                    logger.warning(f"Retry {retry_count + 1}/{max_retries} for HTML cleaning")
-                    retry_count += 1
-                    continue
-                else:
-                    raise ValueError("Could not find valid HTML content in response")
-                
-            if html_match:
-                html_content = html_match.group(0)
-                
-            # Final cleanup
-            html_content = html_content.strip()
-            if not html_content:
-                if retry_count < max_retries - 1:
-                    logger.warning(f"Retry {retry_count + 1}/{max_retries} for empty HTML content")
-                    retry_count += 1
-                    continue
-                else:
-                    raise ValueError("Cleaned HTML content is empty")
-                
-            return html_content
-            
-        except Exception as e:
-            if retry_count < max_retries - 1:
-                logger.warning(f"Retry {retry_count + 1}/{max_retries} after error: {str(e)}")
-                retry_count += 1
-                continue
+            if isinstance(previous_content, str):
+                chunks = [previous_content, html_content]
             else:
-                logger.error(f"Error cleaning HTML response after {max_retries} retries: {str(e)}")
-                raise ValueError("Failed to clean HTML response") from e
+                chunks = [*previous_content, html_content]
+            
+            # The previous chunks hold no complete block, so the combined content
+            # can only have one if this chunk closes it (a closing tag may straddle
+            # the boundary). Until then the chunks are passed on without joining.
+            if CLOSING_TAG_RE.search(chunks[-2][-6:] + html_content) is None:
+                logger.warning("Detected partial HTML document, returning for continuation")
+                return {"status": "partial", "chunks": chunks}
+            html_content = "".join(chunks)
+    
+    # Extract HTML content
+    html_block = extract_html_block(html_content)
+        
+    if html_block is None:
+        # Check if we have a partial HTML document (opening tags without closing tags)
+        # This indicates we need to get more content
+        if OPENING_TAG_RE.search(html_content) is not None:
+            # We have a partial document, return it for continuation
+            logger.warning("Detected partial HTML document, returning for continuation")
+            return {
+                "status": "partial",
+                "chunks": chunks,
+            }
+        
+        # If we can't find valid HTML, log the raw response for debugging
+        logger.error("Failed to find valid HTML structure in response")
+        logger.debug("Response content structure:")
+        logger.debug("-" * 40)
+        # Remove extra newlines for better readability; only the logged head
+        # and tail are normalized, not the whole response
+        head = BLANK_LINES_RE.sub("\n", html_content[:500])
+        tail = BLANK_LINES_RE.sub("\n", html_content[-500:])
+        logger.debug(f"{head}\n ... \n{tail}")
+        logger.debug("-" * 40)
+        raise ValueError("Could not find valid HTML content in response")
+        
+    # Final cleanup
+    html_content = html_block.strip()
+    if not html_content:
+        raise ValueError("Cleaned HTML content is empty")
+        
+    return html_content
@@ -0,0 +1,45 @@
+import json
+
+# orjson is an optional, faster drop-in; fall back to the standard library without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    """
+    Parse JSON from a str or bytes object.
+    
+    Args:
+        data (str | bytes): The JSON document
+        
+    Returns:
+        The parsed Python object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False):
+    """
+    Serialize an object to UTF-8 encoded JSON, keeping non-ASCII text readable.
+    
+    Output is compact unless indent is set.
+    
+    Args:
+        obj: The object to serialize
+        indent (bool, optional): Whether to pretty-print with 2-space indentation
+        
+    Returns:
+        bytes: The encoded JSON document
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
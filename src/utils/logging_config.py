@@ -1,36 +1,88 @@
 import os
+import sys
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from loguru import logger
 
+# Rotated logs are gzipped by a single background worker so rotation never stalls logging
+_compression_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-compression")
 
-def configure_logging(title=None, verbose=True):
+
+# Handlers added by configure_logging, so repeated calls don't stack duplicate sinks.
+# The stderr handler starts out as loguru's default one (id 0, synchronous).
+_stderr_handler_id = 0
+_stderr_settings = (True, False)
+_file_handler_ids = {}
+
+
+def _gzip_log(path):
+    """Gzip a closed log file and remove the original."""
+    with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+
+def _compress_in_background(path):
+    """Loguru compression hook: hand the rotated file to the background worker."""
+    try:
+        _compression_executor.submit(_gzip_log, path)
+    except RuntimeError:
+        # The executor no longer accepts work during interpreter shutdown
+        _gzip_log(path)
+
+
+def configure_logging(title=None, verbose=True, enqueue=False):
     """
     Configure loguru logger to write logs to stderr (if verbose) and to a file in output/title/logs/ folder.
     
+    Safe to call repeatedly: each title's file sink is added once, and the
+    stderr handler is only replaced when verbose or enqueue change.
+    
     Args:
         title (str, optional): The book title to use for the log folder. If None, logs will only go to stderr if verbose is True.
         verbose (bool, optional): Whether to output logs to stderr. Defaults to True.
+        enqueue (bool, optional): Whether stderr output should be written by a background thread. Defaults to False.
     
     Returns:
         The configured logger instance
     """
-    # Remove default stderr handler if not verbose
-    if not verbose:
-        logger.remove()
-    # If title is provided, add file handler
-    if title:
+    global _stderr_handler_id, _stderr_settings
+    
+    # Replace only our own stderr handler, and only when the settings change,
+    # so file sinks and handlers registered elsewhere are left alone
+    if (verbose, enqueue) != _stderr_settings:
+        if _stderr_handler_id is not None:
+            try:
+                logger.remove(_stderr_handler_id)
+            except ValueError:
+                pass  # Already removed elsewhere
+        _stderr_handler_id = logger.add(sys.stderr, enqueue=enqueue) if verbose else None
+        _stderr_settings = (verbose, enqueue)
+    
+    # If title is provided, add file handler once per title
+    if title and title not in _file_handler_ids:
         # Create logs directory
         log_dir = Path("output") / title / "logs"
-        os.makedirs(log_dir, exist_ok=True)
+        log_dir.mkdir(parents=True, exist_ok=True)
         
-        # Add file handler
+        # Add file handler; records are queued to a background writer thread
+        # and written through a 64 KB buffer instead of one syscall per record.
+        # Tracebacks are logged without loguru's variable dumps and extended
+        # frames, which are costly to build and may contain API keys.
         log_file = log_dir / "process.log"
-        logger.add(
-            sink=str(log_file),
+        _file_handler_ids[title] = logger.add(
+            sink=log_file,
             format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
             level="DEBUG",
             rotation="10 MB",
             retention="1 week",
+            compression=_compress_in_background,
+            enqueue=True,
+            buffering=1 << 16,
+            backtrace=False,
+            diagnose=False,
         )
     
     return logger
@@ -1,6 +1,12 @@
 import os
+import json
+import hashlib
+import shutil
 import boto3
 import argparse
+import urllib3.connection
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError, ClientError
 import sys
 import time
@@ -10,43 +16,238 @@ from loguru import logger
 # Configure logger (will be updated with verbose flag in main)
 logger = None
 
+MB = 1024 * 1024
 
-def upload_directory(s3_client, local_folder, bucket_name, s3_folder):
-    for root, dirs, files in os.walk(local_folder):
-        for filename in files:
-            local_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(local_path, local_folder)
-            s3_path = os.path.join(s3_folder, relative_path)
+# Number of files uploaded/downloaded concurrently
+UPLOAD_WORKERS = 16
+DOWNLOAD_WORKERS = 16
 
-            try:
-                logger.info(f"Uploading {local_path} to {s3_path}")
-                s3_client.upload_file(local_path, bucket_name, s3_path)
-            except NoCredentialsError:
-                logger.error("Credentials not available.")
-                sys.exit(1)
-            except ClientError as e:
-                logger.error(f"Failed to upload {local_path} to {s3_path}: {e}")
-            except Exception as e:
-                logger.error(f"Unexpected error: {e}")
+# Large files are split into parts that are transferred in parallel
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB,
+    multipart_chunksize=16 * MB,
+    max_concurrency=10,
+    use_threads=True,
+)
 
+# Buffer size used when streaming object bodies to disk
+COPY_BUFFER_SIZE = MB
 
-def download_directory(s3_client, bucket_name, s3_folder, local_folder):
+# Bounds (in seconds) of the adaptive sync interval
+MIN_SYNC_INTERVAL = 5
+MAX_SYNC_INTERVAL = 60
+
+# Opt-in: raise urllib3's 16 KB socket write buffer for S3 transfers
+BIG_BUFFER_ENV = "PDF2EPUB_S3_BIGBUF"
+BIG_BUFFER_SIZE = MB
+
+
+def enable_big_http_buffer(blocksize=BIG_BUFFER_SIZE):
+    """
+    Replace the default blocksize of every new urllib3 connection.
+
+    urllib3 passes its own blocksize default down to http.client, so the default
+    is patched on urllib3's connection classes, which botocore's connections
+    subclass without overriding it.
+    """
+    for connection_class in (urllib3.connection.HTTPConnection, urllib3.connection.HTTPSConnection):
+        kwdefaults = connection_class.__init__.__kwdefaults__
+        if kwdefaults and "blocksize" in kwdefaults:
+            kwdefaults["blocksize"] = blocksize
+
+
+def get_pooled_blocksize(s3_client):
+    """Return the blocksize of a connection from the S3 client's pool, or None if no pool exists yet."""
+    pools = s3_client._endpoint.http_session._manager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        connection = pool._get_conn()
+        try:
+            return connection.blocksize
+        finally:
+            pool._put_conn(connection)
+    return None
+
+
+if os.environ.get(BIG_BUFFER_ENV) == "1":
+    enable_big_http_buffer()
+
+# Records (size, mtime) of uploaded files so unchanged files are skipped
+MANIFEST_NAME = ".sync_manifest.json"
+
+
+def iter_files(root, prefix=""):
+    """
+    Recursively yield (entry, relative_path) for every file under root.
+
+    Uses os.scandir so file/directory checks are answered from the directory
+    entry itself instead of an extra stat call per file.
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path, prefix + entry.name + "/")
+            elif entry.is_file(follow_symlinks=False):
+                yield entry, prefix + entry.name
+
+
+def get_s3_prefix(s3_folder):
+    """Normalize an S3 folder to a key prefix ending in '/' (empty for the bucket root)."""
+    return s3_folder.rstrip("/") + "/" if s3_folder else ""
+
+
+def get_manifest_path(local_folder):
+    """Place the sync manifest next to the synced folder so it is never uploaded itself."""
+    return os.path.join(os.path.dirname(os.path.abspath(local_folder)), MANIFEST_NAME)
+
+
+def load_manifest(manifest_path):
+    """Load the sync manifest, or return None if it doesn't exist yet."""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError as e:
+        logger.warning(f"Ignoring corrupt sync manifest {manifest_path}: {e}")
+        return None
+
+
+def save_manifest(manifest_path, manifest):
+    """Save the sync manifest atomically, since several monitor processes may share it."""
+    temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+
+def calculate_md5(file_path):
+    """Calculate the MD5 hash of a file, matching the ETag of a single-part upload."""
+    hasher = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(MB), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def seed_manifest(s3_client, local_folder, bucket_name, s3_folder):
+    """
+    Build a manifest for local files that already exist unchanged in the bucket.
+
+    A single listing of the prefix provides size and ETag for every remote object.
+    Local files with a matching size are hashed and recorded when the MD5 equals
+    the ETag, so the first sync cycle doesn't re-upload what was just downloaded.
+    """
+    prefix = get_s3_prefix(s3_folder)
+    remote_objects = {}
     paginator = s3_client.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
         for obj in page.get('Contents', []):
-            if not obj['Key'].endswith('/'):  # skip directories
-                s3_file_path = obj['Key']
-                local_file_path = os.path.join(local_folder, os.path.relpath(s3_file_path, s3_folder))
-                local_file_dir = os.path.dirname(local_file_path)
+            remote_objects[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
 
-                # Ensure the directory exists
-                os.makedirs(local_file_dir, exist_ok=True)
+    manifest = {}
+    for entry, relative_path in iter_files(local_folder):
+        s3_path = prefix + relative_path
+        remote = remote_objects.get(s3_path)
+        if remote is None:
+            continue
+        size, etag = remote
+        stat = entry.stat()
+        # Multipart ETags ("<md5>-<parts>") aren't a plain MD5 of the content
+        if stat.st_size == size and "-" not in etag and calculate_md5(entry.path) == etag:
+            manifest[f"{bucket_name}/{s3_path}"] = [stat.st_size, int(stat.st_mtime)]
 
-                try:
-                    logger.info(f"Downloading {s3_file_path} to {local_file_path}")
-                    s3_client.download_file(bucket_name, s3_file_path, local_file_path)
-                except Exception as e:
-                    logger.error(f"Failed to download {s3_file_path}: {e}")
+    logger.info(f"Seeded sync manifest with {len(manifest)} files already in the bucket")
+    return manifest
+
+
+def upload_directory(s3_client, local_folder, bucket_name, s3_folder, max_workers=UPLOAD_WORKERS, manifest=None):
+    """
+    Upload every file under local_folder to the bucket.
+
+    If a manifest dict is given, files whose size and mtime match the recorded
+    values are skipped, and successful uploads are recorded in it.
+
+    Returns the number of files uploaded successfully.
+    """
+    # Collect every changed file first so the uploads can be spread across the pool
+    prefix = get_s3_prefix(s3_folder)
+    uploads = []
+    for entry, relative_path in iter_files(local_folder):
+        s3_path = prefix + relative_path
+        stat = entry.stat()
+        signature = [stat.st_size, int(stat.st_mtime)]
+        if manifest is not None and manifest.get(f"{bucket_name}/{s3_path}") == signature:
+            continue
+        uploads.append((entry.path, s3_path, signature))
+
+    def upload(item):
+        local_path, s3_path, signature = item
+        try:
+            logger.info(f"Uploading {local_path} to {s3_path}")
+            s3_client.upload_file(local_path, bucket_name, s3_path, Config=TRANSFER_CONFIG)
+            return None
+        except Exception as e:
+            return e
+
+    # boto3 clients are thread-safe, so the same client is shared by all workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(upload, uploads))
+
+    uploaded = 0
+    for (local_path, s3_path, signature), error in zip(uploads, results):
+        if error is None:
+            uploaded += 1
+            if manifest is not None:
+                manifest[f"{bucket_name}/{s3_path}"] = signature
+        elif isinstance(error, NoCredentialsError):
+            logger.error("Credentials not available.")
+            sys.exit(1)
+        elif isinstance(error, ClientError):
+            logger.error(f"Failed to upload {local_path} to {s3_path}: {error}")
+        else:
+            logger.error(f"Unexpected error: {error}")
+
+    return uploaded
+
+
+def download_directory(s3_client, bucket_name, s3_folder, local_folder, max_workers=DOWNLOAD_WORKERS):
+    # A trailing slash lets S3 stop listing at the folder boundary
+    prefix = get_s3_prefix(s3_folder)
+
+    def download(s3_file_path, local_file_path, size):
+        try:
+            logger.info(f"Downloading {s3_file_path} to {local_file_path}")
+            if size >= TRANSFER_CONFIG.multipart_threshold:
+                # Large objects benefit from ranged, multipart downloads
+                s3_client.download_file(bucket_name, s3_file_path, local_file_path, Config=TRANSFER_CONFIG)
+            else:
+                # Small objects are streamed straight to disk with a single GET
+                response = s3_client.get_object(Bucket=bucket_name, Key=s3_file_path)
+                with open(local_file_path, "wb") as f:
+                    shutil.copyfileobj(response['Body'], f, length=COPY_BUFFER_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to download {s3_file_path}: {e}")
+
+    created_dirs = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+
+    # Downloads start as soon as each page of the listing arrives
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for page in pages:
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith('/'):  # skip directories
+                    s3_file_path = obj['Key']
+                    local_file_path = os.path.join(local_folder, s3_file_path[len(prefix):])
+                    local_file_dir = os.path.dirname(local_file_path)
+
+                    # Ensure the directory exists, once per distinct directory
+                    if local_file_dir not in created_dirs:
+                        os.makedirs(local_file_dir, exist_ok=True)
+                        created_dirs.add(local_file_dir)
+
+                    executor.submit(download, s3_file_path, local_file_path, obj['Size'])
 
 
 def main():
@@ -59,14 +260,18 @@ def main():
     parser.add_argument("bucket_name", help="S3 Bucket Name", default="bookepub")
     parser.add_argument("--final", action="store_true", help="Run upload once and then quit")
     parser.add_argument("--download", action="store_true", help="Download from S3 instead of uploading")
+    parser.add_argument("--poll", action="store_true", help="Sync on a fixed 5-minute timer instead of adaptively")
     parser.add_argument("--verbose", action="store_true", help="Display detailed information during execution")
 
     args = parser.parse_args()
     
-    # Initialize logger with verbose flag
+    # Initialize logger with verbose flag; worker threads log per file, so
+    # stderr writes are handed to loguru's background thread
     global logger
-    logger = configure_logging(verbose=args.verbose)
+    logger = configure_logging(verbose=args.verbose, enqueue=True)
     
+    # The client is created once and reused by every sync cycle and worker thread;
+    # re-creating it per cycle would discard its connection pool
     session = boto3.session.Session()
     s3_client = session.client(
         service_name='s3',
@@ -87,17 +292,51 @@ def main():
             logger.error(f"An error occurred: {e}")
             sys.exit(1)
 
+    # Confirm the bigger buffer reached the connections botocore actually uses
+    if os.environ.get(BIG_BUFFER_ENV) == "1":
+        blocksize = get_pooled_blocksize(s3_client)
+        if blocksize == BIG_BUFFER_SIZE:
+            logger.debug(f"S3 connections use a {blocksize}-byte blocksize")
+        else:
+            logger.warning(f"{BIG_BUFFER_ENV}=1 is set but S3 connections use a blocksize of {blocksize}")
+
     if args.download:
         download_directory(s3_client, args.bucket_name, args.s3_folder, args.local_folder)
         logger.info("Download complete. Exiting.")
-    elif args.final:
-        upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder)
+        return
+
+    # Load the sync manifest, seeding it from the bucket on first use
+    manifest_path = get_manifest_path(args.local_folder)
+    manifest = load_manifest(manifest_path)
+    if manifest is None:
+        manifest = seed_manifest(s3_client, args.local_folder, args.bucket_name, args.s3_folder)
+        # Save it straight away, so the next process doesn't hash the tree again
+        # when nothing gets uploaded
+        save_manifest(manifest_path, manifest)
+
+    if args.final:
+        upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder, manifest=manifest)
+        save_manifest(manifest_path, manifest)
         logger.info("Upload complete. Exiting.")
-    else:
+    elif args.poll:
         while True:
-            upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder)
+            upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder, manifest=manifest)
+            save_manifest(manifest_path, manifest)
             logger.info("Waiting 5 minutes before next sync...")
             time.sleep(300)  # Sleep for 5 minutes
+    else:
+        # Idle cycles only walk the local folder (the manifest skips unchanged files),
+        # so sync quickly after changes and back off exponentially while idle
+        interval = MIN_SYNC_INTERVAL
+        while True:
+            uploaded = upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder, manifest=manifest)
+            if uploaded:
+                save_manifest(manifest_path, manifest)
+                interval = MIN_SYNC_INTERVAL
+            else:
+                interval = min(interval * 2, MAX_SYNC_INTERVAL)
+            logger.debug(f"Waiting {interval} seconds before next sync...")
+            time.sleep(interval)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,46 @@
+import io
 import time
+import random
 import functools
+import threading
 import httpx
 from loguru import logger
-from google.genai.types import (
-    GenerateContentConfig,
-    HarmBlockThreshold,
-    HarmCategory,
-    SafetySetting,
-    HttpOptions,
-)
 
 # Set Gemini API timeout to 60 minutes (in milliseconds)
 GEMINI_TIMEOUT = 60 * 60 * 1000  # 60 minutes
 
+# Characters received between streaming progress log lines
+STREAM_PROGRESS_INTERVAL = 4096
+
+# Shortest wait (in seconds) between retries; later waits grow from it with random jitter
+BASE_BACKOFF = 1.0
+
+# Per-thread random generators, so concurrent workers don't share random's global state
+_thread_local = threading.local()
+
+# google.genai is imported inside the functions that use it: importing it takes
+# hundreds of milliseconds, and the entry scripts import this module at startup
+
+
+@functools.lru_cache(maxsize=None)
+def get_safety_settings():
+    """
+    Returns the safety settings shared by every generation config; all categories are unblocked.
+    
+    Returns:
+        list[SafetySetting]: The shared safety settings, which must not be modified
+    """
+    from google.genai import types
+    return [
+        types.SafetySetting(category=category, threshold=types.HarmBlockThreshold.BLOCK_NONE)
+        for category in (
+            types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        )
+    ]
+
 
 def setup_genai_client(api_key):
     """
@@ -25,45 +53,67 @@ def setup_genai_client(api_key):
         genai.Client: The configured Gemini client
     """
     from google import genai
+    from google.genai import types
     return genai.Client(
         api_key=api_key,
-        http_options=HttpOptions(timeout=GEMINI_TIMEOUT)
+        http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT)
     )
 
 
-def get_default_generation_config(temperature=0.1):
+@functools.lru_cache(maxsize=16)
+def get_default_generation_config(temperature=0.1, response_mime_type=None):
     """
     Returns a default GenerateContentConfig with safety settings set to BLOCK_NONE.
     
+    The config is cached per argument combination and shared by every caller, so
+    it must not be modified; derive variants with model_copy(update=...) instead.
+    
     Args:
         temperature (float): The temperature to use for generation
+        response_mime_type (str, optional): The MIME type the response must use
         
     Returns:
         GenerateContentConfig: The default generation config
     """
-    return GenerateContentConfig(
+    from google.genai import types
+    return types.GenerateContentConfig(
         temperature=temperature,
-        safety_settings=[
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HARASSMENT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-            SafetySetting(
-                category=HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                threshold=HarmBlockThreshold.BLOCK_NONE,
-            ),
-        ],
+        safety_settings=get_safety_settings(),
+        response_mime_type=response_mime_type,
     )
 
 
+class AggregatedResponse:
+    """Response-like object holding the text aggregated from a streamed response."""
+    
+    __slots__ = ("text", "parts")
+    
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+
+
+def get_next_backoff(previous_backoff, max_backoff):
+    """
+    Return the next retry wait using decorrelated jitter.
+    
+    Each wait is drawn uniformly between BASE_BACKOFF and three times the
+    previous wait, so workers retrying after a shared outage spread out
+    instead of retrying in lockstep.
+    
+    Args:
+        previous_backoff (float): The previous wait in seconds (BASE_BACKOFF before the first retry)
+        max_backoff (float): Maximum backoff time in seconds
+        
+    Returns:
+        float: The next wait in seconds
+    """
+    rng = getattr(_thread_local, "random", None)
+    if rng is None:
+        rng = _thread_local.random = random.Random()
+    return min(max_backoff, rng.uniform(BASE_BACKOFF, previous_backoff * 3))
+
+
 def retry_with_exponential_backoff(max_retries=3, max_backoff=30):
     """
     Decorator that retries the decorated function with exponential backoff
@@ -79,60 +129,33 @@ def retry_with_exponential_backoff(max_retries=3, max_backoff=30):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            retry_count = 0
-            result = None
-            
-            while result is None and retry_count < max_retries:
+            backoff_time = BASE_BACKOFF
+            for attempt in range(max_retries):
+                if attempt > 0:
+                    # Calculate exponential backoff with jitter
+                    backoff_time = get_next_backoff(backoff_time, max_backoff)
+                    logger.warning(f"Retry attempt {attempt} for {func.__name__}. Waiting {backoff_time:.2f}s...")
+                    time.sleep(backoff_time)
+                
                 try:
-                    if retry_count > 0:
-                        # Calculate exponential backoff with jitter
-                        backoff_time = min(2 ** retry_count + (0.1 * retry_count), max_backoff)
-                        logger.warning(f"Retry attempt {retry_count} for {func.__name__}. Waiting {backoff_time:.2f}s...")
-                        time.sleep(backoff_time)
-                    
                     # Call the original function
-                    result = func(*args, **kwargs)
-                    
-                except httpx.RemoteProtocolError as e:
-                    logger.error(f"RemoteProtocolError during {func.__name__}: {e}")
-                    retry_count += 1
-                    continue
-                    
-                except httpx.ReadTimeout as e:
-                    logger.error(f"ReadTimeout during {func.__name__}: {e}")
-                    retry_count += 1
-                    continue
-                    
-                except httpx.ConnectTimeout as e:
-                    logger.error(f"ConnectTimeout during {func.__name__}: {e}")
-                    retry_count += 1
-                    continue
+                    return func(*args, **kwargs)
                     
                 except httpx.HTTPError as e:
-                    logger.error(f"HTTPError during {func.__name__}: {e}")
-                    retry_count += 1
-                    continue
+                    # Covers RemoteProtocolError, ReadTimeout, ConnectTimeout and other transport errors
+                    logger.error(f"{type(e).__name__} during {func.__name__}: {e}")
                     
                 except Exception as e:
                     logger.error(f"Unexpected error during {func.__name__}: {e}")
-                    retry_count += 1
-                    continue
-                
-                # If we got here with no result, increment retry counter
-                if result is None:
-                    retry_count += 1
             
-            if result is None:
-                raise ValueError(f"Failed to execute {func.__name__} after {max_retries} attempts")
-                
-            return result
+            raise ValueError(f"Failed to execute {func.__name__} after {max_retries} attempts")
         
         return wrapper
     
     return decorator
 
 
-def generate_content_with_retry(client, model, contents, config=None, max_retries=3, max_backoff=30, operation_name="API call", use_streaming=True):
+def generate_content_with_retry(client, model, contents, config=None, max_retries=3, max_backoff=30, operation_name="API call", use_streaming=True, stop_marker=None):
     """
     Helper function to generate content with retry logic for network-related exceptions.
     Supports both streaming and non-streaming modes.
@@ -146,37 +169,39 @@ def generate_content_with_retry(client, model, contents, config=None, max_retrie
         max_backoff: Maximum backoff time in seconds
         operation_name: Name of the operation for logging purposes
         use_streaming: Whether to use streaming mode (default: True)
+        stop_marker: In streaming mode, stop reading the stream once this text has
+            been received, e.g. "</html>" to skip anything after a complete document
         
     Returns:
         In non-streaming mode: The complete generated content response
         In streaming mode: A response object with aggregated text from the stream
     """
-    retry_count = 0
-    response = None
-    
     # Use default config if none provided
     if config is None:
         config = get_default_generation_config()
     
-    while response is None and retry_count < max_retries:
+    from google.genai import errors as genai_errors
+    backoff_time = BASE_BACKOFF
+    for attempt in range(max_retries):
+        if attempt > 0:
+            # Calculate exponential backoff with random jitter
+            backoff_time = get_next_backoff(backoff_time, max_backoff)
+            logger.warning(f"Retry attempt {attempt} for {operation_name}. Waiting {backoff_time:.2f}s...")
+            time.sleep(backoff_time)
+        
         try:
-            if retry_count > 0:
-                # Calculate exponential backoff with jitter
-                backoff_time = min(2 ** retry_count + (0.1 * retry_count), max_backoff)
-                logger.warning(f"Retry attempt {retry_count} for {operation_name}. Waiting {backoff_time:.2f}s...")
-                time.sleep(backoff_time)
-            
             if use_streaming:
                 # Use streaming mode
                 logger.info(f"Using streaming mode for {operation_name}")
                 
-                # Create a response-like object to store the aggregated content
-                class AggregatedResponse:
-                    def __init__(self):
-                        self.text = ""
-                        self.parts = []
-                
-                aggregated_response = AggregatedResponse()
+                # Chunks are collected in a buffer instead of repeatedly
+                # concatenating a growing string
+                buffer = io.StringIO()
+                received = 0
+                next_progress_log = STREAM_PROGRESS_INTERVAL
+                # End of the text already received, kept so a stop marker split
+                # across chunks is still found without rescanning the buffer
+                tail = ""
                 
                 # Generate content with streaming
                 stream_response = client.models.generate_content_stream(
@@ -187,56 +212,52 @@ def generate_content_with_retry(client, model, contents, config=None, max_retrie
                 
                 # Process the stream
                 for chunk in stream_response:
-                    if chunk.text:
-                        aggregated_response.text += chunk.text
-                        # Log progress periodically (every 500 chars)
-                        if len(aggregated_response.text) % 500 < 10:
-                            logger.debug(f"Streaming progress for {operation_name}: {len(aggregated_response.text)} chars received")
+                    text = chunk.text
+                    if not text:
+                        continue
+                    buffer.write(text)
+                    received += len(text)
+                    # Log progress each time another interval's worth has arrived
+                    if received >= next_progress_log:
+                        logger.debug(f"Streaming progress for {operation_name}: {received} chars received")
+                        next_progress_log = received + STREAM_PROGRESS_INTERVAL
+                    
+                    if stop_marker is not None:
+                        window = tail + text
+                        if stop_marker in window:
+                            logger.info(f"Received {stop_marker} for {operation_name}, closing the stream early")
+                            close_stream = getattr(stream_response, "close", None)
+                            if close_stream is not None:
+                                close_stream()
+                            break
+                        tail = window[-(len(stop_marker) - 1):] if len(stop_marker) > 1 else ""
                 
-                response = aggregated_response
-                logger.info(f"Streaming complete for {operation_name}: {len(response.text)} total chars")
+                logger.info(f"Streaming complete for {operation_name}: {received} total chars")
+                return AggregatedResponse(buffer.getvalue())
             else:
                 # Use non-streaming mode (original behavior)
                 logger.info(f"Using non-streaming mode for {operation_name}")
-                response = client.models.generate_content(
+                return client.models.generate_content(
                     model=model,
                     contents=contents,
                     config=config,
                 )
             
-        except httpx.RemoteProtocolError as e:
-            logger.error(f"RemoteProtocolError during {operation_name}: {e}")
-            retry_count += 1
-            continue
-            
-        except httpx.ReadTimeout as e:
-            logger.error(f"ReadTimeout during {operation_name}: {e}")
-            retry_count += 1
-            continue
-            
-        except httpx.ConnectTimeout as e:
-            logger.error(f"ConnectTimeout during {operation_name}: {e}")
-            retry_count += 1
-            continue
-            
         except httpx.HTTPError as e:
-            logger.error(f"HTTPError during {operation_name}: {e}")
-            retry_count += 1
-            continue
+            # Covers RemoteProtocolError, ReadTimeout, ConnectTimeout and other transport errors
+            logger.error(f"{type(e).__name__} during {operation_name}: {e}")
+            
+        except genai_errors.ClientError as e:
+            # Client errors other than rate limiting (429) will fail the same way on retry
+            if e.code != 429:
+                logger.error(f"Non-retriable error during {operation_name}: {e}")
+                raise
+            logger.warning(f"Rate limited during {operation_name}: {e}")
             
         except Exception as e:
             logger.error(f"Unexpected error during {operation_name}: {e}")
-            retry_count += 1
-            continue
-        
-        # If we got here with no response, increment retry counter
-        if response is None:
-            retry_count += 1
     
-    if response is None:
-        raise ValueError(f"Failed to execute {operation_name} after {max_retries} attempts")
-        
-    return response
+    raise ValueError(f"Failed to execute {operation_name} after {max_retries} attempts")
 
 
 def generate_content_with_retry_non_streaming(client, model, contents, config=None, max_retries=3, max_backoff=30, operation_name="API call"):
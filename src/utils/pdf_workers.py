@@ -0,0 +1,180 @@
+"""
+PDF page and image work run in worker processes.
+
+Spawned workers import this module instead of an entry script, so it must stay
+free of import-time side effects: no logging configuration and no Gemini client.
+"""
+
+import os
+from io import BytesIO
+import fitz  # PyMuPDF
+from PIL import Image
+from loguru import logger
+
+# Images whose area on the page holds more text than this are treated as text
+TEXT_PROBE_CHARS = 50
+
+
+def to_jpeg_bytes(image_bytes, image_ext, quality=90):
+    """
+    Convert an extracted image to JPEG bytes.
+
+    Args:
+        image_bytes: Raw image data as returned by MuPDF's extract_image
+        image_ext: Format of image_bytes (e.g. "png", "jpeg")
+        quality: JPEG quality used when re-encoding
+
+    Returns:
+        JPEG encoded bytes; JPEG input is returned unchanged
+    """
+    if image_ext.lower() in ("jpeg", "jpg"):
+        return image_bytes
+
+    img_buffer = BytesIO()
+    with Image.open(BytesIO(image_bytes)) as img:
+        # Single-pass baseline encode; optimize/progressive need extra passes
+        img.convert("RGB").save(img_buffer, format="JPEG", quality=quality, optimize=False, progressive=False)
+    return img_buffer.getvalue()
+
+
+def extract_images_from_pdf_page(pdf_doc, page_num, chapter_index, base_counter=1):
+    """Extract meaningful images from a specific PDF page, returning their bytes rather than writing them."""
+    page = pdf_doc[page_num]
+    page_width, page_height = page.rect.width, page.rect.height
+    extracted_images = []
+    seen_xrefs = set()
+    
+    counter = base_counter
+    # Image info comes from the page's display list, so candidates can be
+    # filtered before paying for extract_image to decode the image stream
+    for info in page.get_image_info(xrefs=True):
+        xref = info["xref"]
+        if not xref or xref in seen_xrefs:
+            continue  # Inline image, or the same image drawn twice
+        seen_xrefs.add(xref)
+        
+        # More aggressively filter small images and better detect full-page text
+        width = info["width"]
+        height = info["height"]
+        
+        # Skip very small images (likely icons or decorations)
+        if width < 100 or height < 100:
+            continue
+        
+        # Skip images that are likely full-page text
+        # This heuristic looks at image dimensions compared to page dimensions
+        if (width > 0.9 * page_width and height > 0.9 * page_height):
+            # This might be a full page scan - skip unless it's actually an image
+            continue
+        
+        # Skip images whose area is mostly covered by text
+        if len(page.get_text("text", clip=fitz.Rect(info["bbox"])).strip()) > TEXT_PROBE_CHARS:
+            continue
+        
+        base_image = pdf_doc.extract_image(xref)
+        image_bytes = base_image["image"]
+        image_ext = base_image["ext"]
+        
+        # Convert to JPEG for compatibility
+        if image_ext.lower() not in ["jpeg", "jpg"]:
+            try:
+                image_bytes = to_jpeg_bytes(image_bytes, image_ext)
+                image_ext = "jpg"
+            except Exception as e:
+                logger.error(f"Error converting image: {e}")
+                continue
+        
+        image_filename = f"chapter_{chapter_index}_img_{counter}.{image_ext}"
+        
+        extracted_images.append({
+            "filename": image_filename,
+            "bytes": image_bytes,
+            "page": page_num,
+            "width": width,
+            "height": height
+        })
+        
+        counter += 1
+    
+    return extracted_images, counter
+
+
+def extract_placeholder_images(pdf_bytes, pages, chapter_index):
+    """
+    Extract the image for each placeholder of a chapter.
+
+    Runs in a worker process, so the chapter PDF is passed as bytes and
+    reopened here rather than shared as a document handle.
+
+    Args:
+        pdf_bytes: The chapter PDF as returned by Document.tobytes()
+        pages: Placeholder page numbers, relative to the start of the chapter
+        chapter_index: Index of the chapter, used in the image filenames
+
+    Returns:
+        A list with, for each entry of pages, a (filename, image bytes) tuple or None
+    """
+    images = []
+    image_counter = 1
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as chapter_pdf:
+        for relative_page in pages:
+            # Calculate the actual page in the PDF
+            actual_page = min(relative_page, len(chapter_pdf) - 1)
+
+            # Extract images from this page
+            extracted_images, _ = extract_images_from_pdf_page(
+                chapter_pdf, actual_page, chapter_index, image_counter
+            )
+
+            if extracted_images:
+                img = extracted_images[0]  # Use the first extracted image
+                images.append((img["filename"], img["bytes"]))
+                image_counter += 1
+            else:
+                images.append(None)
+    return images
+
+
+# Per-process render state: the PDF opened by the last render_page call
+_render_document_key = None
+_render_document = None
+
+
+def get_document_key(path):
+    """Identify a PDF file by path and inode/mtime, so workers notice when it is replaced."""
+    stat = os.stat(path)
+    return (os.fspath(path), stat.st_ino, stat.st_mtime_ns)
+
+
+def render_page(document_key, zoom, grayscale, quality, page_num):
+    """
+    Render one page of a PDF and return it as JPEG bytes.
+
+    Runs in a worker process, which keeps the PDF open between calls and only
+    reopens it when document_key changes.
+
+    Args:
+        document_key: The PDF's key as returned by get_document_key
+        zoom: Scale factor applied to the page (72 DPI is 1)
+        grayscale: Whether to render straight to grayscale
+        quality: JPEG compression quality (0-100)
+        page_num: The 0-based page to render
+
+    Returns:
+        JPEG encoded bytes of the page
+    """
+    global _render_document_key, _render_document
+    if document_key != _render_document_key:
+        if _render_document is not None:
+            _render_document.close()
+        _render_document = fitz.open(document_key[0])
+        _render_document_key = document_key
+
+    page = _render_document[page_num]
+
+    # Convert page to image; rendering straight to grayscale avoids converting it afterwards
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+
+    # Encode as JPEG with specified quality directly from the pixmap buffer
+    return pix.tobytes("jpg", jpg_quality=quality)